@@ -0,0 +1,86 @@
+""" Throttled, deduplicated "please auth" direct messages to non-authed members """
+
+import asyncio
+import collections
+import logging
+import sys
+import time
+
+
+class AuthPrompter:
+    """ Asks non-authed members to auth, at most once per reask_interval seconds.
+    The times of the prompts are stored in discordbot_auth_prompts, so a restart
+    does not ask everybody again. Prompts are sent from a queue, at most rate
+    per second """
+
+    def __init__(self, model, send, should_ask, reask_interval=86400, rate=0.5):
+        self.model = model
+        self.send = send # coroutine send(member), sends the prompt
+        self.should_ask = should_ask # should_ask(member_id): False once the member authed or left
+        self.reask_interval = reask_interval
+        self.rate = rate
+
+        self.asked = {} # member id -> time of the last prompt (unix time)
+        self.loaded = False
+        self.queue = collections.OrderedDict() # member id -> member
+        self.queued = asyncio.Event()
+
+        self.sent = 0
+        self.deferred = 0
+        self.skipped = 0
+
+    def was_asked(self, member_id):
+        return member_id in self.asked and time.time() - self.asked[member_id] < self.reask_interval
+
+    def request(self, member):
+        """ queues a prompt for member, unless it was asked recently or is waiting
+        already. Returns True if the prompt was queued """
+        member_id = str(member.id)
+        if self.was_asked(member_id):
+            self.skipped += 1
+            return False
+        if member_id in self.queue:
+            return False
+        if len(self.queue) > 0:
+            self.deferred += 1
+        self.queue[member_id] = member
+        self.queued.set()
+        return True
+
+    @asyncio.coroutine
+    def load(self):
+        """ loads the recent prompts (e.g., from before a restart) """
+        self.asked.update((yield from self.model.get_auth_prompts(self.reask_interval)))
+        self.loaded = True
+        logging.info("Auth prompts: loaded %d recent prompts", len(self.asked))
+
+    @asyncio.coroutine
+    def run(self):
+        """ sends the queued prompts, one every 1 / rate seconds """
+        while True:
+            yield from self.queued.wait()
+            try:
+                if not self.loaded:
+                    yield from self.load()
+
+                member_id, member = self.queue.popitem(last=False)
+                if len(self.queue) == 0:
+                    self.queued.clear()
+
+                if self.was_asked(member_id) or not self.should_ask(member_id):
+                    self.skipped += 1
+                    continue
+
+                self.asked[member_id] = time.time()
+                yield from self.send(member)
+                self.sent += 1
+                yield from self.model.set_auth_prompt(member_id)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Auth prompts: failed to ask a member to auth: " + str(sys.exc_info()[0]))
+
+            yield from asyncio.sleep(1.0 / self.rate)
+
+    def get_stats_str(self):
+        return "{} sent, {} deferred, {} skipped, {} waiting".format(self.sent, self.deferred, self.skipped, len(self.queue))
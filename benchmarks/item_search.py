@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Benchmark: !item lookups through the trigram ItemIndex vs. the LIKE '%x%' query.
+
+Needs the database from the config file (same format as for runbot.py). Both
+paths are run for every search string and their results are compared.
+
+    python benchmarks/item_search.py --config local.cfg --repeat 20
+"""
+
+import argparse
+import asyncio
+import configparser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pymysql
+import pymysql.cursors
+
+from model import ConnectionPool, MyDBModel
+from staticdata import ItemIndex
+
+SEARCH_STRINGS = ["Tritanium", "rifter", "Large Shield", "Damage Control II", "ore", "Capital",
+                  "Blueprint", "Nanite Repair Paste", "xyzzy", "Ra"]
+
+
+@asyncio.coroutine
+def benchmark(model, repeat):
+    start = time.monotonic()
+    items = yield from model.get_all_published_items()
+    loaded = time.monotonic()
+    index = ItemIndex(items)
+    built = time.monotonic()
+    print("loaded {} items in {:.2f} s, built index in {:.2f} s".format(len(items), loaded - start, built - loaded))
+
+    print("{:22} {:>12} {:>12} {:>8}".format("search", "sql (ms)", "index (ms)", "same"))
+    for search in SEARCH_STRINGS:
+        start = time.monotonic()
+        for i in range(0, repeat):
+            sql_result = yield from model.find_item_in_db(search)
+        sql_time = (time.monotonic() - start) / repeat
+
+        start = time.monotonic()
+        for i in range(0, repeat):
+            index_result = index.find(search)
+        index_time = (time.monotonic() - start) / repeat
+
+        print("{:22} {:>12.3f} {:>12.3f} {:>8}".format(search, sql_time * 1000, index_time * 1000,
+                                                       str(sql_result == index_result)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Item search: trigram index vs. SQL")
+    parser.add_argument('--config', help='Specify the config file to use', default='defaults.cfg')
+    parser.add_argument('--repeat', type=int, default=20, help='lookups per search string')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(['defaults.cfg', args.config])
+
+    def connect():
+        return pymysql.connect(host=config.get('Database', 'dbhost'),
+                               user=config.get('Database', 'dbuser'),
+                               password=config.get('Database', 'dbpass'),
+                               db=config.get('Database', 'dbname'),
+                               charset='utf8mb4',
+                               autocommit=True,
+                               cursorclass=pymysql.cursors.DictCursor)
+
+    model = MyDBModel(ConnectionPool(connect, 1))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(benchmark(model, args.repeat))
+    model.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+""" Benchmark: event loop latency while several commands query the database.
+
+Measures how late a heartbeat-like coroutine wakes up while N concurrent
+"commands" run queries, once with the queries blocking the event loop (old
+behaviour, one shared connection) and once through the threaded MyDBModel
+with a connection pool.
+
+The database is simulated by a connection whose queries take --query-time
+seconds, so no MySQL server is needed.
+
+    python benchmarks/loop_latency.py --commands 8 --pool-size 4
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from model import ConnectionPool, MyDBModel
+
+
+class SlowCursor:
+    """ a cursor that takes query_time seconds per query and returns no rows """
+    def __init__(self, query_time):
+        self.query_time = query_time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        return iter([])
+
+    def execute(self, sql, args=None):
+        time.sleep(self.query_time)
+        return 0
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class SlowConnection:
+    """ a fake pymysql connection """
+    def __init__(self, query_time):
+        self.query_time = query_time
+
+    def cursor(self):
+        return SlowCursor(self.query_time)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@asyncio.coroutine
+def heartbeat(interval, stop, lags):
+    """ sleeps interval seconds and records how late it woke up """
+    while not stop.is_set():
+        start = time.monotonic()
+        yield from asyncio.sleep(interval)
+        lags.append(time.monotonic() - start - interval)
+
+
+@asyncio.coroutine
+def blocking_command(model, repeat):
+    """ old behaviour: run the query directly on the event loop """
+    find_item_in_db = MyDBModel.find_item_in_db.__wrapped__
+    for i in range(0, repeat):
+        model.run_with_connection(find_item_in_db, "Tritanium")
+        yield from asyncio.sleep(0)
+
+
+@asyncio.coroutine
+def threaded_command(model, repeat):
+    """ new behaviour: run the query on the thread pool """
+    for i in range(0, repeat):
+        yield from model.find_item_in_db("Tritanium")
+
+
+def run(command, args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    model = MyDBModel(ConnectionPool(lambda: SlowConnection(args.query_time), args.pool_size))
+    stop = asyncio.Event()
+    lags = []
+
+    @asyncio.coroutine
+    def main():
+        beat = asyncio.async(heartbeat(args.interval, stop, lags))
+        start = time.monotonic()
+        done, pending = yield from asyncio.wait([asyncio.async(command(model, args.repeat)) for i in range(0, args.commands)])
+        duration = time.monotonic() - start
+        stop.set()
+        yield from beat
+        # a failing command would make the numbers meaningless
+        for task in done:
+            task.result()
+        return duration
+
+    duration = loop.run_until_complete(main())
+    model.close()
+    loop.close()
+
+    lags.sort()
+    return duration, lags[len(lags) // 2], lags[int(len(lags) * 0.99)], lags[-1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event loop latency under concurrent database load")
+    parser.add_argument('--commands', type=int, default=8, help='number of concurrent commands')
+    parser.add_argument('--repeat', type=int, default=10, help='queries per command')
+    parser.add_argument('--query-time', type=float, default=0.02, help='simulated query time in seconds')
+    parser.add_argument('--pool-size', type=int, default=4, help='database connection pool size')
+    parser.add_argument('--interval', type=float, default=0.01, help='heartbeat interval in seconds')
+    args = parser.parse_args()
+
+    print("{} commands x {} queries, {:.0f} ms per query, pool size {}".format(
+        args.commands, args.repeat, args.query_time * 1000, args.pool_size))
+    print("{:10} {:>10} {:>12} {:>12} {:>12}".format("mode", "total (s)", "lag p50 (ms)", "lag p99 (ms)", "lag max (ms)"))
+    for name, command in [("blocking", blocking_command), ("threaded", threaded_command)]:
+        duration, p50, p99, worst = run(command, args)
+        print("{:10} {:>10.2f} {:>12.1f} {:>12.1f} {:>12.1f}".format(name, duration, p50 * 1000, p99 * 1000, worst * 1000))
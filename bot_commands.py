@@ -2,6 +2,7 @@
 
 import logging
 import asyncio
+import collections
 from datetime import datetime
 import json
 import urllib
@@ -9,12 +10,21 @@ import urllib.request
 import urllib.parse
 
 from model import MyDBModel
+from message_utils import split_lines
 import random
+import re
 import sys, inspect
 import discord
 import traceback
 
 
+def did_you_mean(suggestions):
+    """ returns a "did you mean" string for a list of suggestions (or an empty string) """
+    if len(suggestions) == 0:
+        return ""
+    return ". Did you mean " + ", ".join(suggestions) + "?"
+
+
 class AbstractBotCommand:
     available_commands = {}
 
@@ -50,10 +60,11 @@ class AbstractBotCommand:
         if not msg.startswith("!"):
             return
 
-        if " " in msg:
-            cmd =  msg[msg.find("!"):msg.find(" ")]
+        whitespace = re.search(r"\s", msg)
+        if whitespace:
+            cmd =  msg[msg.find("!"):whitespace.start()]
             # extract params
-            params = msg[msg.find(" ")+1:]
+            params = msg[whitespace.start()+1:]
         else: # new line at the end, so we are fine
             cmd =  msg[msg.find("!"):]
             params = ""
@@ -68,7 +79,7 @@ class AbstractBotCommand:
             except Exception as e:
                 logging.exception("Unexpected error while dispatching...")
                 logging.error(traceback.format_exc())
-                yield from AbstractBotCommand.available_commands[cmd].client.send_to_debug_channel(
+                yield from AbstractBotCommand.available_commands[cmd].client.send_debug_error(
                     "Unexpected error while dispatching '{}': {}".format(cmd, traceback.format_exc()))
         else:
             logging.info("Command '%s' not found...", cmd)
@@ -99,7 +110,7 @@ class WhoisBotCommand:
 
             print("wanted_id=" + str(wanted_member_id))
             if wanted_member_id in self.client.authed_users:
-                char_data = self.model.get_discord_members_character_id(wanted_member_id)
+                char_data = yield from self.model.get_discord_members_character_id(wanted_member_id)
 
                 combined_message = "<@%(author_id)s> is authed as %(char_name)s (%(corp_name)s)" % \
                                    {
@@ -128,7 +139,7 @@ class WhoamiBotCommand:
         logging.info("in WhoamiBotCommand.handle_command()")
 
         if message.author.id in self.client.authed_users:
-            char_data = self.model.get_discord_members_character_id(message.author.id)
+            char_data = yield from self.model.get_discord_members_character_id(message.author.id)
             combined_message = "<@%(author_id)s> is authed as %(char_name)s (%(corp_name)s)" % \
                                {
                                    'author_id': message.author.id,
@@ -209,10 +220,43 @@ class ListMyRolesCommand:
     @asyncio.coroutine
     def handle_command(self, message, cmd, params):
         if message.channel == self.client.debug_channel:
-            roles = self.client.get_member_roles(message.author.id)
+            roles = yield from self.client.get_member_roles(message.author.id)
             yield from self.client.send_message(message.channel, ",".join(roles))
 
 
+class StatsCommand:
+    def __init__(self, db_model, discord_client):
+        self.client = discord_client
+        self.model = db_model
+        self.cmd = "!stats"
+
+    @asyncio.coroutine
+    def handle_command(self, message, cmd, params):
+        logging.info("in StatsCommand.handle_command()")
+        if message.channel == self.client.debug_channel:
+            # some statistics span several lines, split them so no message gets too long
+            lines = "\n".join(self.client.get_stats()).split("\n")
+            for msg in split_lines(lines):
+                yield from self.client.send_message(message.channel, msg)
+
+
+class ApplyRolesCommand:
+    def __init__(self, db_model, discord_client):
+        self.client = discord_client
+        self.model = db_model
+        self.cmd = "!apply_roles"
+
+    @asyncio.coroutine
+    def handle_command(self, message, cmd, params):
+        logging.info("in ApplyRolesCommand.handle_command()")
+        if message.channel == self.client.debug_channel:
+            if self.client.authed_users_reload_refused:
+                yield from self.client.reload_authed_members(force=True)
+                yield from self.client.send_message(message.channel, "Reloaded {} authed members".format(len(self.client.authed_users)))
+            number = yield from self.client.role_reconciler.apply_held(self.client.roles, self.client.everyone_group)
+            yield from self.client.send_message(message.channel, "Applied {} held back role changes".format(number))
+
+
 class UpdateRolesCommand:
     def __init__(self, db_model, discord_client):
         self.client = discord_client
@@ -359,13 +403,14 @@ class FindPOSBotCommand:
         if "directors" in channelname or "managers" in channelname or "debug" in channelname or "it_room" in channelname:
             poslist = None
             if params == "":
-                poslist = self.model.find_pos()
+                poslist = yield from self.model.find_pos()
             else:
-                result = self.model.find_system(params)
+                result = yield from self.model.find_system(params)
                 if result == None:
-                    yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown System")
+                    suggestions = yield from self.model.suggest_system(params)
+                    yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown System" + did_you_mean(suggestions))
                 elif isinstance(result, dict):
-                    poslist = self.model.find_pos(result['solarSystemID'])
+                    poslist = yield from self.model.find_pos(result['solarSystemID'])
                 else:
                     resultstr = ", ".join(result)
                     yield from self.client.send_message(message.channel,
@@ -389,11 +434,12 @@ class FindItemBotCommand:
     @asyncio.coroutine
     def handle_command(self, message, cmd, params):
         logging.info("in FindItemBotCommand.handle_command()")
-        result = self.model.find_item(params)
+        result = yield from self.model.find_item(params)
         if result == None:
-            yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown Item")
+            suggestions = yield from self.model.suggest_item(params)
+            yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown Item" + did_you_mean(suggestions))
         elif isinstance(result, dict):
-            isk = self.model.get_item_price(result['id'])
+            isk = yield from self.model.get_item_price(result['id'])
             if isk != None:
                 price = " ({:,}".format(isk) + " ISK)"
             else:
@@ -408,6 +454,95 @@ class FindItemBotCommand:
 
 
 
+class AppraiseBotCommand:
+    def __init__(self, db_model, discord_client):
+        self.client = discord_client
+        self.model = db_model
+        self.cmd = "!appraise"
+
+    @staticmethod
+    def parse_quantity(quantity_str):
+        """ parses quantities like 1,000 or 1.000 """
+        quantity_str = quantity_str.replace(",", "").replace(".", "").replace(" ", "")
+        if quantity_str.isdigit():
+            return int(quantity_str)
+        return None
+
+    @staticmethod
+    def parse_inventory(text):
+        """ parses a pasted inventory (one item per line, "Item Name x Qty", "Qty x Item Name"
+        or tab separated "Item Name<TAB>Qty<TAB>...") into a list of [name, quantity],
+        adding up the quantities of items that are listed more than once """
+        quantities = collections.OrderedDict()
+        for line in text.splitlines():
+            line = line.strip()
+            if line == "":
+                continue
+
+            name = line
+            quantity = 1
+            if "\t" in line:
+                columns = line.split("\t")
+                name = columns[0].strip()
+                if len(columns) > 1 and AppraiseBotCommand.parse_quantity(columns[1]) is not None:
+                    quantity = AppraiseBotCommand.parse_quantity(columns[1])
+            else:
+                match = re.match(r"^(.+?)\s+x\s*([\d,.]+)$", line, re.IGNORECASE)
+                if match:
+                    name, quantity = match.group(1), AppraiseBotCommand.parse_quantity(match.group(2))
+                else:
+                    match = re.match(r"^([\d,.]+)\s*x\s+(.+)$", line, re.IGNORECASE)
+                    if match:
+                        name, quantity = match.group(2), AppraiseBotCommand.parse_quantity(match.group(1))
+
+            if quantity is None:
+                quantity = 1
+            if name.lower() in quantities:
+                quantities[name.lower()][1] += quantity
+            else:
+                quantities[name.lower()] = [name, quantity]
+        return list(quantities.values())
+
+    @asyncio.coroutine
+    def handle_command(self, message, cmd, params):
+        logging.info("in AppraiseBotCommand.handle_command()")
+        inventory = AppraiseBotCommand.parse_inventory(params)
+        if len(inventory) == 0:
+            yield from self.client.send_message(message.channel,
+                                                "<@" + message.author.id + "> Please paste your items after !appraise (one item per line, e.g. ``Tritanium x 1000``)")
+            return
+
+        # resolve all names and fetch all prices at once
+        items = yield from self.model.find_items_by_name([name for name, quantity in inventory])
+        prices = yield from self.model.get_item_prices([item['id'] for item in items.values()])
+
+        appraised = []
+        unknown = []
+        no_price = []
+        for name, quantity in inventory:
+            item = items.get(name.lower())
+            if item is None:
+                unknown.append(name)
+            elif prices.get(item['id']) is None:
+                no_price.append(item['name'])
+            else:
+                appraised.append((float(prices[item['id']]) * quantity, item['name'], quantity))
+
+        total = sum([value for value, name, quantity in appraised])
+        appraised.sort(reverse=True)
+
+        lines = ["<@" + message.author.id + "> Appraisal of {} items: {:,.2f} ISK".format(len(appraised), total)]
+        for value, name, quantity in appraised:
+            lines.append("{} x {:,}: {:,.2f} ISK".format(name, quantity, value))
+        if len(no_price) > 0:
+            lines.append("No price for: " + ", ".join(no_price))
+        if len(unknown) > 0:
+            lines.append("Unknown items: " + ", ".join(unknown))
+
+        for msg in split_lines(lines):
+            yield from self.client.send_message(message.channel, msg)
+
+
 class FindSystemBotCommand:
     def __init__(self, db_model, discord_client):
         self.client = discord_client
@@ -417,9 +552,10 @@ class FindSystemBotCommand:
     @asyncio.coroutine
     def handle_command(self, message, cmd, params):
         logging.info("in FindSystemBotCommand.handle_command()")
-        result = self.model.find_system(params)
+        result = yield from self.model.find_system(params)
         if result == None:
-            yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown System")
+            suggestions = yield from self.model.suggest_system(params)
+            yield from self.client.send_message(message.channel, "<@" + message.author.id + "> Unknown System" + did_you_mean(suggestions))
         elif isinstance(result, dict):
             dotlan_str = "http://evemaps.dotlan.net/system/" + result['solarSystemName'].replace(" ", "_")
             yield from self.client.send_message(message.channel,
@@ -517,7 +653,7 @@ class KillboardBotCommand:
         logging.info("in KillboardBotCommand.handle_command()")
         # get number of kills of this member
         if message.author.id in self.client.authed_users:
-            number_kills = self.model.get_discord_members_number_of_kills(message.author.id)
+            number_kills = yield from self.model.get_discord_members_number_of_kills(message.author.id)
             if number_kills < 100:
                 yield from self.client.send_message(message.channel, "Whelp... you only have %d killmails... " % number_kills)
             elif number_kills < 500:
@@ -708,7 +844,7 @@ class ModifyPingTimespanCommand:
             if stop_hour > 24:
                 stop_hour = 24
 
-            self.model.update_ping_start_stop_hour(message.author.id, start_hour, stop_hour)
+            yield from self.model.update_ping_start_stop_hour(message.author.id, start_hour, stop_hour)
 
             yield from self.client.send_message(message.channel,
                                                 "<@" + message.author.id + "> Okay, I will ping you between " + str(start_hour) + ":00 and " + str(stop_hour) + ":00 UTC (EVE Time)")
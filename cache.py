@@ -0,0 +1,51 @@
+""" Small in-memory caches used by the database model """
+
+import collections
+import time
+
+
+class TTLCache:
+    """ A size bounded LRU cache whose entries expire ttl seconds after they were
+    stored. Counts hits and misses. Raises KeyError for missing or expired keys """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires, value), least recently used first
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        if key in self.entries:
+            expires, value = self.entries[key]
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def refresh(self, items):
+        """ bulk update from a dictionary: refreshes all cached keys and adds new keys
+        as long as there is room, without evicting any entries """
+        expires = time.monotonic() + self.ttl
+        for key in items.keys():
+            if key in self.entries or len(self.entries) < self.max_size:
+                self.entries[key] = (expires, items[key])
+
+    def get_stats_str(self):
+        """ returns a short summary of size, hits and misses """
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups > 0 else 0.0
+        return "{} entries, {} hits, {} misses ({:.1f}% hits)".format(len(self.entries), self.hits, self.misses, hit_rate)
@@ -0,0 +1,84 @@
+""" Batching of debug channel messages into digests """
+
+import asyncio
+import collections
+import logging
+
+from message_utils import MAX_MESSAGE_LENGTH, split_lines
+
+
+class DebugSink:
+    """ Collects debug messages and events for window seconds and sends them as a
+    few digest messages. Events of the same kind are summarized in one line
+    ("37 non-authed users connected: a, b, c ..."). Immediate messages (e.g.,
+    errors) flush everything that is pending right away """
+
+    def __init__(self, send, window=5.0, prefix="DEBUG: ", max_items=30):
+        self.send = send # coroutine send(message, immediate)
+        self.window = window
+        self.prefix = prefix
+        self.max_items = max_items # names shown per event line
+
+        self.lines = []
+        self.events = collections.OrderedDict() # summary -> list of items
+        self.pending = asyncio.Event()
+
+        self.messages = 0
+        self.digests = 0
+
+    def add_message(self, msg):
+        self.lines.append(msg)
+        self.messages += 1
+        self.pending.set()
+
+    def add_event(self, summary, item):
+        """ e.g., add_event("non-authed users connected", member.name) """
+        self.events.setdefault(summary, []).append(str(item))
+        self.messages += 1
+        self.pending.set()
+
+    def get_digest_lines(self):
+        """ returns (and clears) the pending messages and event lines """
+        lines = []
+        for summary, items in self.events.items():
+            line = "{} {}: {}".format(len(items), summary, ", ".join(items[:self.max_items]))
+            if len(items) > self.max_items:
+                line += " ... and {} more".format(len(items) - self.max_items)
+            lines.append(line)
+        lines += self.lines
+
+        self.events.clear()
+        self.lines = []
+        self.pending.clear()
+        return lines
+
+    @asyncio.coroutine
+    def flush(self, immediate=False):
+        """ sends the pending messages, immediate messages must not be dropped """
+        lines = self.get_digest_lines()
+        for msg in split_lines(lines, MAX_MESSAGE_LENGTH - len(self.prefix)):
+            self.digests += 1
+            try:
+                yield from self.send(self.prefix + msg, immediate)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Failed to send a debug digest", exc_info=True)
+
+    @asyncio.coroutine
+    def send_now(self, msg):
+        """ sends msg together with everything that is pending right away """
+        self.add_message(msg)
+        yield from self.flush(immediate=True)
+
+    @asyncio.coroutine
+    def run(self):
+        """ sends a digest window seconds after the first pending message """
+        while True:
+            yield from self.pending.wait()
+            yield from asyncio.sleep(self.window)
+            yield from self.flush()
+
+    def get_stats_str(self):
+        return "{} messages in {} digests, {} pending".format(
+            self.messages, self.digests, len(self.lines) + sum([len(items) for items in self.events.values()]))
@@ -6,11 +6,20 @@ import logging
 import random
 from datetime import datetime
 import traceback
+import collections
+import time
 
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import discord
 from model import MyDBModel
+from killmails import KillmailRule, parse_killmail_rules
+from roles import PingWindowWheel, ReconcileQueue, RoleReconciler, SweepLane, get_sweep_delay, is_in_ping_window
+from auth_prompts import AuthPrompter
+from debug_sink import DebugSink
+from dispatcher import OutboundDispatcher, PRIORITY_ALERT, PRIORITY_AUTH, PRIORITY_COMMAND, PRIORITY_DEBUG, PRIORITY_FLEET
+from histogram import LatencyHistogram
+from fleetbot import AdaptivePoller, FleetbotOutbox, PingDeduplicator, coalesce_pings
 
 import bot_commands
 from bot_commands import AbstractBotCommand
@@ -38,27 +47,72 @@ class MyDiscordBotClient(discord.Client):
     handles authentication with a pre-defined EvE Online auth database """
     def __init__(self, db, debug_channel_name, auth_website, main_server_id,
                  time_dep_groups, fleetbot_channels, post_expensive_killmails_to,
-                 run_verify_user_loop=True):
+                 run_verify_user_loop=True, auth_maintenance_interval=3600,
+                 price_cache_size=50000, price_cache_ttl=1800, price_refresh_interval=600,
+                 fleetbot_batch_size=100, fleetbot_max_attempts=5, fleetbot_retry_delay=5,
+                 fleetbot_coalesce=False, fleetbot_dedupe_window=300, fleetbot_dedupe_shared=False,
+                 fleetbot_min_poll_interval=1.0, fleetbot_max_poll_interval=30.0, fleetbot_notify_socket="",
+                 killmail_rules="", killmail_batch_size=50,
+                 role_sync_event_driven=True, role_sync_full_interval=3600, role_sync_db_interval=30,
+                 role_removal_limit=25, role_removal_limit_percent=10, role_removal_window=3600,
+                 role_sync_offline_interval=21600, role_sync_pass_budget=10, debug_digest_interval=5,
+                 auth_prompt_reask_interval=86400, auth_prompt_rate=0.5):
         self.db = db # the database
         self.debug_channel_name = debug_channel_name
         self.auth_website = auth_website
 
         # store the database model
-        self.model = MyDBModel(self.db)
+        self.model = MyDBModel(self.db, price_cache_size, price_cache_ttl)
+
+        # every message goes through the dispatcher, see send_message
+        self.dispatcher = OutboundDispatcher(self.send_message_now)
+        # debug messages are sent as digests every debug_digest_interval seconds
+        self.debug_sink = DebugSink(self.send_debug_digest, debug_digest_interval)
+
+        # asks non-authed members to auth, see check_member
+        self.auth_prompter = AuthPrompter(self.model, self.send_auth_prompt, self.should_ask_to_auth,
+                                          auth_prompt_reask_interval, auth_prompt_rate)
+        self.price_refresh_interval = price_refresh_interval
 
         self.authed_users = {}
+        # highest discord_auth.updated_at that has been synced into authed_users
+        self.authed_users_watermark = None
+        self.authed_users_reload_refused = False # see reload_authed_members
+        self.auth_maintenance_interval = auth_maintenance_interval
+        # members by the hours at which their ping window opens or closes
+        self.ping_window_wheel = PingWindowWheel()
 
         # Store a couple of destinations for messages
         self.debug_channel = None
 
         self.group_channels = {}
 
-        self.post_expensive_killmails_to = post_expensive_killmails_to
-        self.post_expensive_killmails_channel = None
+        # rules that decide which killmails are posted where, see killmails.py
+        self.killmail_rules = parse_killmail_rules(killmail_rules)
+        if len(self.killmail_rules) == 0 and post_expensive_killmails_to != "":
+            self.killmail_rules.append(KillmailRule(post_expensive_killmails_to))
+        self.killmail_channels = {} # channel name -> channel
+        self.killmail_batch_size = killmail_batch_size
 
         self.currently_online_members = {} # a list of online users
         self.roles = {}
         self.everyone_group = None
+        self.role_reconciler = RoleReconciler(self.replace_roles, self.send_debug_error,
+                                              role_removal_limit, role_removal_limit_percent,
+                                              removal_window=role_removal_window)
+        self.reported_unknown_roles = set() # role IDs that were reported to the debug channel
+        # time between receiving a valid auth token and applying the roles
+        self.auth_latency = LatencyHistogram()
+        # event driven role sync: members are reconciled when they change, the full
+        # sweep is only a safety net. Without events, the full sweep runs every 30 s
+        self.reconcile_queue = ReconcileQueue()
+        self.role_sync_event_driven = role_sync_event_driven
+        self.role_sync_db_interval = role_sync_db_interval
+        # the full sweep runs in two lanes (online and offline members), every pass of
+        # a lane stops after role_sync_pass_budget seconds and is continued later
+        self.fast_lane = SweepLane("fast", role_sync_full_interval if role_sync_event_driven else 30)
+        self.slow_lane = SweepLane("slow", role_sync_offline_interval)
+        self.role_sync_pass_budget = role_sync_pass_budget
 
         self.main_server_id = main_server_id
         self.main_server = None
@@ -68,10 +122,26 @@ class MyDiscordBotClient(discord.Client):
 
         self.timedep_group_assignment = {}
         self.fleetbot_channels = {}
-
+        self.fleetbot_batch_size = fleetbot_batch_size
+        self.fleetbot_coalesce = fleetbot_coalesce
+        self.fleetbot_deduplicator = PingDeduplicator(fleetbot_dedupe_window)
+        self.fleetbot_dedupe_shared = fleetbot_dedupe_shared
+        self.fleetbot_poller = AdaptivePoller(fleetbot_min_poll_interval, fleetbot_max_poll_interval)
+        self.fleetbot_notify_socket = fleetbot_notify_socket
+        self.fleetbot_outbox = FleetbotOutbox(self.model, self.send_to_channel_id, self.send_debug_error,
+                                              fleetbot_max_attempts, fleetbot_retry_delay)
+
+        self.dispatcher_loop = None
+        self.debug_sink_loop = None
+        self.auth_prompter_loop = None
         self.verify_users_loop = None
+        self.reconcile_members_loop = None
+        self.ping_window_loop = None
         self.forward_fleetbot_loop = None
+        self.fleetbot_outbox_loop = None
         self.forward_zkill_loop = None
+        self.maintain_auth_loop = None
+        self.refresh_prices_loop = None
 
         self.do_verify_users = run_verify_user_loop
 
@@ -112,6 +182,14 @@ class MyDiscordBotClient(discord.Client):
         logging.info("OnReady: Logged in as %s (id: %s)",
                      self.user.name, self.user.id)
 
+        # all messages are sent by the dispatcher
+        if self.dispatcher_loop is None or self.dispatcher_loop.done():
+            self.dispatcher_loop = asyncio.async(self.dispatcher.run())
+        if self.debug_sink_loop is None or self.debug_sink_loop.done():
+            self.debug_sink_loop = asyncio.async(self.debug_sink.run())
+        if self.auth_prompter_loop is None or self.auth_prompter_loop.done():
+            self.auth_prompter_loop = asyncio.async(self.auth_prompter.run())
+
         logging.info("Checking which servers we are connected to")
         for serv in self.servers:
             if serv.id == self.main_server_id:
@@ -129,33 +207,87 @@ class MyDiscordBotClient(discord.Client):
         # Send a message to a destination
         yield from self.send_to_debug_channel("I am back {}!".format(str(datetime.now())))
 
+        # load static data (e.g., solar systems) into memory
+        try:
+            yield from self.model.load_static_data()
+        except:
+            logging.error("Failed to load static data, falling back to database queries", exc_info=True)
+
+        # members that were asked to auth recently (before the first pass over all members)
+        try:
+            if not self.auth_prompter.loaded:
+                yield from self.auth_prompter.load()
+        except:
+            logging.error("Failed to load the auth prompts", exc_info=True)
+
         AbstractBotCommand.import_bot_commands(self.model, self)
 
         # verify users, run this until the end
         logging.info("starting async loops...")
         loop = asyncio.get_event_loop()
-        self.verify_users_loop = asyncio.async(self.verify_users(self.main_server))
+        if self.verify_users_loop is None or self.verify_users_loop.done():
+            self.verify_users_loop = asyncio.async(self.verify_users(self.main_server))
+        if self.role_sync_event_driven and (self.reconcile_members_loop is None or self.reconcile_members_loop.done()):
+            self.reconcile_members_loop = asyncio.async(self.reconcile_members(self.main_server))
+        if len(self.timedep_group_assignment) > 0 and (self.ping_window_loop is None or self.ping_window_loop.done()):
+            self.ping_window_loop = asyncio.async(self.schedule_ping_windows(self.main_server))
+        if self.maintain_auth_loop is None or self.maintain_auth_loop.done():
+            self.maintain_auth_loop = asyncio.async(self.maintain_auth_table())
+        if self.refresh_prices_loop is None or self.refresh_prices_loop.done():
+            self.refresh_prices_loop = asyncio.async(self.refresh_price_cache())
         if len(self.fleetbot_channels) > 0:
-            logging.info("Starting new fleetbot loop, checking old loop before")
-            logging.info(self.forward_fleetbot_loop)
-
-            self.forward_fleetbot_loop = asyncio.async(self.forward_fleetbot_messages())
+            # two forwarders would read from the same watermark and post every ping twice
+            if self.forward_fleetbot_loop is None or self.forward_fleetbot_loop.done():
+                logging.info("Starting new fleetbot loop")
+                self.forward_fleetbot_loop = asyncio.async(self.forward_fleetbot_messages())
+            if self.fleetbot_outbox_loop is None or self.fleetbot_outbox_loop.done():
+                self.fleetbot_outbox_loop = asyncio.async(self.fleetbot_outbox.run())
+            if self.fleetbot_notify_socket != "" and self.fleetbot_poller.server is None:
+                try:
+                    yield from self.fleetbot_poller.listen(self.fleetbot_notify_socket)
+                except:
+                    logging.error("Failed to listen on fleetbot notify socket", exc_info=True)
 
         # start forward zkill loop
-        if self.forward_zkillboard_expensive_killmails != "":
+        if len(self.killmail_rules) > 0 and (self.forward_zkill_loop is None or self.forward_zkill_loop.done()):
             self.forward_zkill_loop = asyncio.async(self.forward_zkillboard_expensive_killmails())
 
     def stop_additional_loops(self):
         """ stops verify users loop and forward fleetbot loop """
+        if self.dispatcher_loop:
+            logging.info("stopping dispatcher loop")
+            self.dispatcher_loop.cancel()
+        if self.debug_sink_loop:
+            logging.info("stopping debug sink loop")
+            self.debug_sink_loop.cancel()
+        if self.auth_prompter_loop:
+            logging.info("stopping auth prompter loop")
+            self.auth_prompter_loop.cancel()
         if self.verify_users_loop:
             logging.info("stopping verify user loop")
             self.verify_users_loop.cancel()
+        if self.reconcile_members_loop:
+            logging.info("stopping reconcile members loop")
+            self.reconcile_members_loop.cancel()
+        if self.ping_window_loop:
+            logging.info("stopping ping window loop")
+            self.ping_window_loop.cancel()
         if self.forward_fleetbot_loop:
             logging.info("stopping forward fleetbot loop")
             self.forward_fleetbot_loop.cancel()
+        if self.fleetbot_outbox_loop:
+            logging.info("stopping fleetbot outbox loop")
+            self.fleetbot_outbox_loop.cancel()
+        self.fleetbot_poller.close()
         if self.forward_zkill_loop:
             logging.info("stopping forward zkill loop")
             self.forward_zkill_loop.cancel()
+        if self.maintain_auth_loop:
+            logging.info("stopping maintain auth loop")
+            self.maintain_auth_loop.cancel()
+        if self.refresh_prices_loop:
+            logging.info("stopping refresh prices loop")
+            self.refresh_prices_loop.cancel()
 
 
     def update_channels(self, server):
@@ -176,8 +308,8 @@ class MyDiscordBotClient(discord.Client):
                         self.group_channels[bckey] = [ channel ]
                     else:
                         self.group_channels[bckey].append(channel)
-            if channel.name == self.post_expensive_killmails_to:
-                self.post_expensive_killmails_channel = channel
+            if channel.name in [rule.channel_name for rule in self.killmail_rules]:
+                self.killmail_channels[channel.name] = channel
 
     def update_roles(self, server):
         """ Update the list of roles """
@@ -197,6 +329,23 @@ class MyDiscordBotClient(discord.Client):
 
         return retstr
 
+    def get_stats(self):
+        """ Returns a list of lines with statistics (caches, queues, ...) """
+        stats = []
+        stats.append("Dispatcher: " + self.dispatcher.get_stats_str())
+        stats.append("Debug digests: " + self.debug_sink.get_stats_str())
+        stats.append("Auth prompts: " + self.auth_prompter.get_stats_str())
+        stats.append("Auth to roles latency: " + self.auth_latency.get_stats_str())
+        stats.append("Price cache: " + self.model.price_cache.get_stats_str())
+        stats.append("Roles: " + self.role_reconciler.get_stats_str())
+        stats.append("Reconcile queue: " + self.reconcile_queue.get_stats_str())
+        stats.append("Sweep lanes: " + self.fast_lane.get_stats_str() + "; " + self.slow_lane.get_stats_str())
+        stats.append("Ping windows: " + self.ping_window_wheel.get_stats_str())
+        stats.append("Fleetbot polling: " + self.fleetbot_poller.get_stats_str())
+        stats.append("Fleetbot dedupe: " + self.fleetbot_deduplicator.get_stats_str())
+        stats.append("Fleetbot outbox: " + self.fleetbot_outbox.get_stats_str())
+        return stats
+
     def clear_online_members(self):
         """ clears the list of online members - mainly for debug purpose """
         self.currently_online_members.clear()
@@ -204,33 +353,43 @@ class MyDiscordBotClient(discord.Client):
 
     @asyncio.coroutine
     def handle_auth_token(self, author, auth_token):
-        """ handles an auth token sent by author """
+        """ handles an auth token sent by author: claims the token, applies the roles
+        and then sends the notifications """
+        received = time.monotonic()
+        member_id = str(author.id)
 
         logging.info("Verifying auth token '%s' for user %s", auth_token, str(author.name))
-        if self.model.is_auth_code_in_table(auth_token):
+        auth_data = yield from self.model.claim_auth_token(auth_token, member_id)
+        if auth_data is not None:
             logging.info("Token is valid!")
-            # update member_id for auth_code
-            self.model.set_discord_member_id_for_auth_code(auth_token, str(author.id))
-
-            char_data = self.model.get_discord_members_character_id(str(author.id))
-            character_name, corp_name, character_id = char_data
-
-            yield from self.send_message(author, "Hello {}! You are now authed, your corp is {}!".format(character_name, corp_name))
-            yield from self.send_to_debug_channel("User {} just authed as {} (corp {}, char id {}) ".format(str(author.name), character_name, corp_name, character_id))
-
-            # assign roles for this user
-            tmproles = self.model.get_roles_for_member(str(author.id))
-            logging.info("Member %s will be assigned the following roles: %s", author.name, str(tmproles))
-
-            new_roles = [self.roles[str(f)] for f in tmproles]
-
-            # get member based on message.author.id
-            member = self.currently_online_members[author.id]
+            self.authed_users[member_id] = auth_data['authed_member']
+            self.ping_window_wheel.update(member_id, auth_data['authed_member']['start_hour'],
+                                          auth_data['authed_member']['stop_hour'])
+
+            # assign roles for this user (including time dependent roles) first
+            member = self.main_server.get_member(member_id) if self.main_server is not None else None
+            if member is not None:
+                should_have_roles = yield from self.get_member_roles(member_id, auth_data['roles'])
+                logging.info("Member %s will be assigned the following roles: %s", author.name, str(should_have_roles))
+                change, unknown = self.role_reconciler.plan(member, should_have_roles, self.roles, self.everyone_group)
+                if change is None:
+                    self.auth_latency.record(time.monotonic() - received)
+                else:
+                    yield from self.role_reconciler.apply([change], 1, len(self.main_server.members))
+                    # without the pause after replace_roles (held or failed changes are not recorded)
+                    if change.applied_at is not None:
+                        self.auth_latency.record(change.applied_at - received)
+                yield from self.report_unknown_roles(unknown)
+            else:
+                logging.error("User %s authed, but is not a member of the main server", author.name)
 
-            yield from self.add_roles(member, *new_roles)
+            character_name, corp_name, character_id = auth_data['character_name'], auth_data['corp_name'], auth_data['character_id']
+            yield from self.send_message(author, "Hello {}! You are now authed, your corp is {}!".format(character_name, corp_name),
+                                         priority=PRIORITY_AUTH)
+            self.debug_event("users authed", "{} as {} (corp {}, char id {})".format(str(author.name), character_name, corp_name, character_id))
         else:
             logging.error("Could not find token '%s' in database...", auth_token)
-            yield from self.send_message(author, "Sorry, I did not recognize the auth code you sent me!")
+            yield from self.send_message(author, "Sorry, I did not recognize the auth code you sent me!", priority=PRIORITY_AUTH)
             yield from self.send_to_debug_channel("User {} entered auth key {}, but I could not find it in database".format(author.name, auth_token))
 
     @asyncio.coroutine
@@ -257,7 +416,7 @@ class MyDiscordBotClient(discord.Client):
                         # remove "auth=" from that string"
                         auth_code = str(message.content).replace("auth=", "")
 
-                        yield from self.send_to_debug_channel("User {} just entered an auth token, verifying...".format(message.author))
+                        self.debug_event("users entered an auth token", message.author)
 
                         yield from self.handle_auth_token(message.author, auth_code)
                 else:
@@ -274,14 +433,14 @@ class MyDiscordBotClient(discord.Client):
                     importlib.reload(bot_commands)
                     AbstractBotCommand.import_bot_commands(self.model, self)
                     avail_cmds = " ".join(AbstractBotCommand.available_commands.keys())
-                    yield from self.send_to_debug_channel("Commands reloaded! Available commands: " + avail_cmds)
+                    yield from self.send_to_debug_channel("Commands reloaded! Available commands: " + avail_cmds, immediate=True)
                 elif msg.startswith("!restart") and message.channel == self.debug_channel:
                     logging.info("restarting the bot...")
                     raise KeyboardInterrupt
                 elif msg.startswith("!clear_online_members") and message.channel == self.debug_channel:
                     logging.info("Trying to clear online users...")
                     self.clear_online_members()
-                    yield from self.send_to_debug_channel("Cleared currently online members")
+                    yield from self.send_to_debug_channel("Cleared currently online members", immediate=True)
                 elif "I LOVE" in msg.upper():
                     yield from self.send_message(message.channel, "I am sure you do ;) :panda_face: ")
                 elif "I HATE" in msg.upper():
@@ -296,31 +455,21 @@ class MyDiscordBotClient(discord.Client):
                     #    logging.debug("Ignoring message, because its from ourselves...")
 
 
-    def get_member_roles(self, member_id):
-        """ returns a list of roles that the member should have """
-        should_have_roles = self.model.get_roles_for_member(member_id)
+    @asyncio.coroutine
+    def get_member_roles(self, member_id, group_roles=None):
+        """ returns a list of roles that the member should have. group_roles are the
+        roles from the database (see get_roles_for_all_members), if they are None
+        they are queried for this member """
+        if group_roles is None:
+            should_have_roles = yield from self.model.get_roles_for_member(member_id)
+        else:
+            should_have_roles = list(group_roles)
 
         ping_start_hour = int(self.authed_users[member_id]['start_hour'])
         ping_stop_hour = int(self.authed_users[member_id]['stop_hour'])
 
-        cur_hour = datetime.utcnow().hour
-
-        do_time_dep_roles = False
-
-        # case 0: user does not care about any time dependency
-        if ping_start_hour == 0 and ping_stop_hour == 0:
-            do_time_dep_roles = True  # always assign
-        else:
-            # case 1: ping_start_hour < ping_stop_hour, e.g., between 8 and 22 hours
-            if ping_start_hour < ping_stop_hour and cur_hour >= ping_start_hour and cur_hour < ping_stop_hour:
-                do_time_dep_roles = True
-
-            # case 2: ping_start_hour > ping_stop_hour, e.g., between 16 and 4 hours
-            if ping_start_hour > ping_stop_hour and (cur_hour >= ping_start_hour or cur_hour < ping_stop_hour):
-                do_time_dep_roles = True
-
-        if do_time_dep_roles:
-            for role in should_have_roles:
+        if is_in_ping_window(ping_start_hour, ping_stop_hour, datetime.utcnow().hour):
+            for role in list(should_have_roles):
                 if role in self.timedep_group_assignment:
                     should_have_roles.append(self.timedep_group_assignment[role])
 
@@ -328,126 +477,145 @@ class MyDiscordBotClient(discord.Client):
 
 
     @asyncio.coroutine
-    def verify_member_roles(self, member, member_id):
-        """ checks the roles of a single member, and adds or removes them as needed """
-        try:
-            # which roles should this member have
-            should_have_roles = self.get_member_roles(member_id)
-
-            # check if there are any roles that we need to remove
-            roles_to_remove = []
-
-            for role in member.roles:
-                # needs to keep the everyone group
-                if role == self.everyone_group:
-                    continue
-                if str(role.id) not in should_have_roles:
-                    logging.info("Member {} has role {} (ID: {}), but should not have it... removing".format(member.name, role.name, role.id))
-                    roles_to_remove.append(role)
-                else:
-                    should_have_roles.remove(role.id)
-
-            # remove those roles if neccessary
-            if len(roles_to_remove) > 0:
-                yield from self.remove_roles(member, *roles_to_remove)
-                yield from asyncio.sleep(0.5)
-
-
-            roles_to_add = []
-            # anything left in should_have_roles should be assigned
-            for role_id in should_have_roles:
-                # try to find role_id in self.roles
-                if role_id in self.roles:
-                    role = self.roles[role_id]
-                    logging.info("Member {} is missing role {} (ID: {}), adding it now".format(member.name, role.name, role.id))
-                    roles_to_add.append(role)
-                else:
-                    logging.error("Member {} is missing role with role_id='{}', tried to add it but I could not find that role... Available roles are: {}".format(member.name, role_id, self.roles.keys()))
-                    yield from self.send_to_debug_channel(
-                        "Member {} is missing role with role_id='{}', tried to add it but I could not find that role... Available roles are: {}".format(
-                            member.name, role_id, self.roles.keys()))
-
-            if len(roles_to_add) > 0:
-                yield from self.add_roles(member, *roles_to_add)
-                yield from asyncio.sleep(0.5)
-        except:
-            logging.info("Caught an exception in verify_member_roles... Probably rate limited?")
-            tb = traceback.format_exc()
-            logging.info(str(sys.exc_info()[0]))
-            logging.info(tb)
-            yield from asyncio.sleep(3)
-
-
-    @asyncio.coroutine
-    def post_killmail_to_chan(self, external_kill_ID):
-        """ Method for forwarding a zkill link to post_expensive_killmails_channel"""
-        if self.post_expensive_killmails_channel != None and external_kill_ID != 0:
-            yield from self.send_message(self.post_expensive_killmails_channel, "https://zkillboard.com/kill/" + str(external_kill_ID) + "/")
+    def post_killmail_to_chan(self, channel, external_kill_ID):
+        """ Method for forwarding a zkill link to a channel """
+        if channel != None and external_kill_ID != 0:
+            yield from self.send_message(channel, "https://zkillboard.com/kill/" + str(external_kill_ID) + "/")
 
     def forward_zkillboard_expensive_killmails(self):
+        """ Posts every kill since the persisted watermark (killmail_last_id) to the
+        channels whose killmail rules match it """
         logging.info("starting zkillboard forward loop")
 
-        last_id = 0
+        last_id = None
+        # one query for all rules: the lowest threshold, joins only for the conditions in use
+        min_value = min([rule.min_value for rule in self.killmail_rules])
+        with_regions = len([rule for rule in self.killmail_rules if rule.regions is not None]) > 0
+        with_ship_groups = len([rule for rule in self.killmail_rules if rule.ship_groups is not None]) > 0
 
         while True:
-            if self.post_expensive_killmails_channel != None:
-                killmail_id = self.model.get_expensive_killmails(last_id)
-                if killmail_id != 0:
-                    logging.info("returned killmail_id=" + str(killmail_id))
-                    yield from self.post_killmail_to_chan(killmail_id)
-                    last_id = killmail_id
+            try:
+                if last_id is None:
+                    last_id = yield from self.model.get_bot_state('killmail_last_id')
+                    if last_id is None:
+                        # first start: do not post the kills of the last hours
+                        last_id = yield from self.model.get_killmail_max_id()
+                        yield from self.model.set_bot_state('killmail_last_id', last_id)
+                    last_id = int(last_id)
+
+                kills = yield from self.model.get_expensive_killmails(last_id, min_value, self.killmail_batch_size,
+                                                                      with_regions, with_ship_groups)
+                for kill in kills:
+                    # every kill is posted at most once per channel, even if several rules of the channel match
+                    channel_names = []
+                    for rule in self.killmail_rules:
+                        if rule.matches(kill) and rule.channel_name in self.killmail_channels \
+                                and rule.channel_name not in channel_names:
+                            logging.info("Killmail %s (%s ISK) matches %s", kill['id'], kill['value'], rule)
+                            channel_names.append(rule.channel_name)
+
+                    for channel_name in channel_names:
+                        try:
+                            yield from self.post_killmail_to_chan(self.killmail_channels[channel_name], kill['id'])
+                        except:
+                            logging.error("Caught exception while posting killmail: " + str(sys.exc_info()[0]))
 
-            yield from asyncio.sleep(30)
+                if len(kills) > 0:
+                    last_id = kills[-1]['id']
+                    yield from self.model.set_bot_state('killmail_last_id', last_id)
+            except:
+                logging.error("Caught an exception in forward_zkillboard_expensive_killmails", exc_info=True)
+                kills = []
+
+            # a full batch means that there are probably more kills waiting
+            if len(kills) < self.killmail_batch_size:
+                yield from asyncio.sleep(30)
 
 
     def forward_fleetbot_messages(self):
-        """ Method for forwarding messages to fleetbot channels """
+        """ Method for forwarding messages to fleetbot channels. Reads irc_ping_history
+        in batches ordered by id and puts the pings into the fleetbot outbox, together
+        with the id of the last message (fleetbot_last_message_id), so nothing is lost
+        or read twice across restarts. The outbox sends them to discord """
         logging.info("starting forward_fleetbot_messages loop")
-        try:
 
-            # store the highest fleetbot message id
-            last_fleetbot_msg_id = self.model.get_fleetbot_max_message_id()
+        last_fleetbot_msg_id = None
+        failing = False # only the first error of a series is sent to the debug channel
+
+        while True:
+            try:
+                if last_fleetbot_msg_id is None:
+                    # resume from the last forwarded fleetbot message id
+                    last_fleetbot_msg_id = yield from self.model.get_bot_state('fleetbot_last_message_id')
+                    if last_fleetbot_msg_id is None:
+                        # first start: do not forward the whole history
+                        last_fleetbot_msg_id = yield from self.model.get_fleetbot_max_message_id()
+                        yield from self.model.set_bot_state('fleetbot_last_message_id', last_fleetbot_msg_id)
+                    last_fleetbot_msg_id = int(last_fleetbot_msg_id)
+                    logging.info("Last Fleetbot message id = " + str(last_fleetbot_msg_id))
 
-            while True:
                 logging.info("Checking if there are new messages to forward for fleetbot")
                 # get up2date messages from database
-                messages = self.model.get_fleetbot_messages(last_fleetbot_msg_id)
-                logging.info("Found %d messages with the following keys: %s", len(messages.keys()), str(messages.keys()))
-
-                # go over all groups
-                for group in messages.keys():
-                    logging.info("In for loop: group='%s'", group)
-                    if group in self.group_channels.keys():
-                        # get messages for group
-                        msgs = messages[group]
-                        logging.info("There are %d messages available for group '%s'", len(msgs), group)
-
-                        for i in range(0, len(msgs)):
-                            if msgs[i]['forward']:
-                                new_msg = "@everyone " + msgs[i]['from'] + ": " + msgs[i]['message']
-                                logging.info("Fleetbot(%s): %s", group, new_msg)
-                                try:
-                                    yield from self.send_to_fleetbot_channel(group, new_msg)
-                                except:
-                                    logging.error("Caught exception while forwarding: " + str(sys.exc_info()[0]))
-                    else:
+                messages = yield from self.model.get_fleetbot_messages(last_fleetbot_msg_id, self.fleetbot_batch_size)
+                logging.info("Found %d messages", len(messages))
+
+                # put the pings for all channels of the group into the outbox
+                entries = []
+                pings_by_channel = collections.OrderedDict()
+                dedupe_keys = set() # remembered by the deduplicator once the batch is stored
+                for msg in messages:
+                    group = msg['group']
+                    if group not in self.group_channels.keys():
                         logging.info("Error: Could not find group with name '%s' to forward ...", group)
-
-                # update highest fleetbot message id
-                last_fleetbot_msg_id = self.model.get_fleetbot_max_message_id()
-                logging.info("Last Fleetbot message id = " + str(last_fleetbot_msg_id))
-
-                yield from asyncio.sleep(30)
-                # end while
-        except:
-            tb = traceback.format_exc()
-            logging.info(str(sys.exc_info()[0]))
-            logging.info(tb)
-
-            yield from self.send_to_debug_channel("An error happened: " + str(sys.exc_info()[0]) + "\n" + str(tb))
-
-
-            # also forward this to the debug channel
+                    elif not self.fleetbot_dedupe_shared and self.fleetbot_deduplicator.is_duplicate(group, msg['message'], dedupe_keys):
+                        logging.info("Fleetbot(%s): suppressed duplicate %s", group, msg['message'])
+                    else:
+                        ping = msg['from'] + ": " + msg['message']
+                        logging.info("Fleetbot(%s): %s", group, ping)
+                        for channel in self.group_channels[group]:
+                            # shared dedupe: groups that go to the same channel share their hashes
+                            if self.fleetbot_dedupe_shared and self.fleetbot_deduplicator.is_duplicate(channel.id, msg['message'], dedupe_keys):
+                                logging.info("Fleetbot(%s): suppressed duplicate for channel %s", group, channel.name)
+                            elif self.fleetbot_coalesce:
+                                pings_by_channel.setdefault(channel.id, []).append(ping)
+                            else:
+                                entries.append((channel.id, "@everyone " + ping))
+
+                # coalesce mode: as few messages per channel as possible
+                for channel_id in pings_by_channel.keys():
+                    for new_msg in coalesce_pings(pings_by_channel[channel_id]):
+                        entries.append((channel_id, new_msg))
+
+                # store the pings and the highest fleetbot message id
+                if len(messages) > 0:
+                    yield from self.fleetbot_outbox.enqueue(entries, messages[-1]['id'])
+                    self.fleetbot_deduplicator.record(dedupe_keys)
+                    last_fleetbot_msg_id = messages[-1]['id']
+                    logging.info("Last Fleetbot message id = " + str(last_fleetbot_msg_id))
+
+                if failing:
+                    logging.info("forward_fleetbot_messages recovered")
+                    failing = False
+            except asyncio.CancelledError:
+                raise
+            except:
+                tb = traceback.format_exc()
+                logging.error("Caught an exception in forward_fleetbot_messages\n" + tb)
+
+                # also forward this to the debug channel
+                if not failing:
+                    failing = True
+                    yield from self.send_debug_error("An error happened: " + str(sys.exc_info()[0]) + "\n" + str(tb))
+
+                # back off and try again
+                yield from asyncio.sleep(self.fleetbot_poller.max_interval)
+                continue
+
+            # a full batch means that there are probably more messages waiting
+            if len(messages) < self.fleetbot_batch_size:
+                self.fleetbot_poller.update(len(messages) > 0)
+                yield from self.fleetbot_poller.wait()
+            # end while
     # end def forward_fleetbot_messages
 
     def get_sever_member_by_id(self, server, member_id):
@@ -457,105 +625,380 @@ class MyDiscordBotClient(discord.Client):
 
         return None
 
-    def verify_users(self, server):
-        """ verify that groups of all users currently online are valid"""
-        logging.info("Start loop: Verifying roles of users")
+    @asyncio.coroutine
+    def reload_authed_members(self, force=False):
+        """ reloads all authed members from database into self.authed_users. Unless
+        force is set, a result without (too many of) the known authed members is
+        refused and reported, see RoleReconciler.is_mass_removal. Returns True if
+        authed_users was replaced """
+        authed_users, watermark = yield from self.model.get_all_authed_members()
+
+        lost = len([member_id for member_id in self.authed_users.keys() if member_id not in authed_users])
+        if not force and self.role_reconciler.is_mass_removal(lost, len(self.authed_users)):
+            self.authed_users_reload_refused = True
+            logging.error("Reload of authed members refused: %d of %d members would no longer be authed",
+                          lost, len(self.authed_users))
+            yield from self.send_debug_error(
+                "Reload of authed members refused: {} of {} members would no longer be authed. Check the database, then use !apply_roles to reload anyway.".format(
+                    lost, len(self.authed_users)))
+            return False
+
+        self.authed_users_reload_refused = False
+        self.authed_users.clear()
+        self.authed_users.update(authed_users)
+        self.authed_users_watermark = watermark
+        self.ping_window_wheel.rebuild(self.authed_users)
+        return True
 
-        while self.do_verify_users:
-            # update list of authed members from database
-            self.authed_users = self.model.get_all_authed_members()
-            #logging.info("Received %s authed users from database", len(self.authed_users))
+    @asyncio.coroutine
+    def sync_authed_members(self):
+        """ updates self.authed_users in place with the rows of discord_auth that
+        changed since the last sync (reloads everything if there was no sync yet).
+        Returns the list of IDs of the members whose entry changed (empty after a reload) """
+        if self.authed_users_watermark is None:
+            yield from self.reload_authed_members()
+            return []
+
+        changed_users, self.authed_users_watermark = yield from self.model.get_changed_authed_members(self.authed_users_watermark)
+
+        # the rows of the watermark second come back on every sync (updated_at >= watermark),
+        # only members whose row differs from the cached one changed
+        changed_ids = []
+        for member_id in changed_users.keys():
+            if changed_users[member_id] == self.authed_users.get(member_id):
+                continue
+            changed_ids.append(member_id)
+            if changed_users[member_id] is None:
+                self.authed_users.pop(member_id, None)
+                self.ping_window_wheel.remove(member_id)
+            else:
+                self.authed_users[member_id] = changed_users[member_id]
+                self.ping_window_wheel.update(member_id, changed_users[member_id]['start_hour'],
+                                              changed_users[member_id]['stop_hour'])
+        return changed_ids
 
-            newOnlineMembers = {}
-            allOnlineMembers = {}
+    def maintain_auth_table(self):
+        """ deletes pending auth users and reloads all authed members (which also
+        catches deleted rows), every auth_maintenance_interval seconds """
+        logging.info("Start loop: Maintaining discord_auth")
 
-            number_authed_users = 0
+        while True:
+            try:
+                number = yield from self.model.delete_pending_auth_members()
+                logging.info("Deleted %d pending auth users", number)
 
-            logging.info("Checking all members that are connected on server (length={})...".format(len(server.members)))
+                if self.authed_users_watermark is not None:
+                    if (yield from self.reload_authed_members()):
+                        logging.info("Reloaded %d authed users", len(self.authed_users))
+            except:
+                logging.error("Caught an exception in maintain_auth_table", exc_info=True)
 
+            yield from asyncio.sleep(self.auth_maintenance_interval)
 
-            # iterate over all members:
-            for member in server.members:
-                if member.id == self.user.id:
-                    continue  # skip own bot user
+    def refresh_price_cache(self):
+        """ reloads all prices into the price cache every price_refresh_interval seconds """
+        logging.info("Start loop: Refreshing price cache")
 
-                #if str(member.status) == 'offline':
-                #    continue # no need to process offline members for now
+        while True:
+            try:
+                number = yield from self.model.refresh_prices()
+                logging.info("Refreshed price cache with %d prices (%s)", number, self.model.price_cache.get_stats_str())
+            except:
+                logging.error("Caught an exception in refresh_price_cache", exc_info=True)
 
-                member_id = str(member.id)
+            yield from asyncio.sleep(self.price_refresh_interval)
 
-                # store in all online members
-                allOnlineMembers[member_id] = member
+    @asyncio.coroutine
+    def check_member(self, member, is_new, group_roles=None):
+        """ plans the role change of a single member and asks non-authed members that
+        just connected (is_new) to auth. group_roles are the roles from the database,
+        see get_member_roles. Returns the RoleChange (or None) and the unknown roles """
+        member_id = str(member.id)
+
+        # if this user already known/authed?
+        if member_id in self.authed_users:
+            if is_new:
+                logging.info("User %s just connected, already authed!", member.name)
+
+            # we already know this user, user is authed. check for any role updates
+            should_have_roles = yield from self.get_member_roles(member_id, group_roles)
+            return self.role_reconciler.plan(member, should_have_roles, self.roles, self.everyone_group)
+
+        # we do not know this user, make sure this user has no roles (other than everyone)
+        change, unknown = self.role_reconciler.plan(member, [], self.roles, self.everyone_group)
+        if change is not None:
+            logging.info("Found non-authed member %s with roles %s, removing them...", member.name, member.roles)
+
+        # no need to go any further with offline users
+        if str(member.status) == 'offline':
+            return change, unknown
+
+        if is_new:
+            logging.info("A new user connected to the server: Name='{}', Status='{}', ID='{}', Server='{}'".format(member.name, member.status, member_id, member.server))
+
+            # this user just got online and is not authed! ask this user to auth (unless asked recently)
+            if self.auth_prompter.request(member):
+                self.debug_event("non-authed users connected, asking them to auth", member.name)
+        else:
+            # this user has been online for some time, no need to ask to auth again (I guess)
+            logging.info("Waiting on auth for user: Name='%s', Status='%s', ID='%s', Server='%s'",member.name, member.status, member_id, member.server)
 
-                # if this user already known/authed?
-                if member_id in self.authed_users:
-                    number_authed_users += 1
+        return change, unknown
 
-                    if member_id not in self.currently_online_members:
-                        logging.info("User %s just connected, already authed!", member.name)
-                        newOnlineMembers[member_id] = member
+    @asyncio.coroutine
+    def report_unknown_roles(self, unknown_roles):
+        """ reports roles that members should have but that do not exist (once per role) """
+        if not unknown_roles.issubset(self.reported_unknown_roles):
+            self.reported_unknown_roles.update(unknown_roles)
+            yield from self.send_to_debug_channel(
+                "Members should have roles {}, but I could not find them... Available roles are: {}".format(
+                    sorted(unknown_roles), list(self.roles.keys())))
 
-                    logging.info("Checking roles for member id={} name={}".format(member_id, member.name))
+    @asyncio.coroutine
+    def start_sweep_pass(self, server, lane):
+        """ fills lane with the members of server it is responsible for: the fast lane
+        gets online members and members whose discord_auth row changed, the slow
+        lane gets offline members """
+        now = time.monotonic()
+        group_roles = yield from self.model.get_roles_for_all_members()
+
+        if lane is self.fast_lane:
+            # update list of authed members from database
+            changed_ids = yield from self.sync_authed_members()
 
-                    # else: we already know this user, user is authed. check for any role updates
-                    yield from self.verify_member_roles(member, member_id)
+            # forget members that left the server
+            for member_id in list(self.currently_online_members.keys()):
+                if server.get_member(member_id) is None:
+                    logging.info("Member %s left the server!", self.currently_online_members[member_id].name)
+                    del self.currently_online_members[member_id]
 
-                else: # we do not know this user
-                    # make sure this user has no roles (other than everyone)
-                    if len(member.roles) > 1:
-                        logging.info("Found non-authed member %s with roles %s, removing them...", member.name, member.roles)
-                        roles_to_remove = []
-                        for role in member.roles:
-                            if role != self.everyone_group:
-                                roles_to_remove.append(role)
-                        # remove those roles
-                        yield from self.remove_roles(member, *roles_to_remove)
+            member_ids = [str(member.id) for member in server.members if str(member.status) != 'offline']
+            member_ids += [member_id for member_id in changed_ids if member_id not in member_ids]
+        else:
+            member_ids = [str(member.id) for member in server.members if str(member.status) == 'offline']
 
-                    # no need to go any further with offline users
-                    if str(member.status) == 'offline':
-                        continue
+        logging.info("Starting a %s lane pass over %d of %d members", lane.name, len(member_ids), len(server.members))
+        lane.start_pass(member_ids, group_roles, now)
 
-                    if member_id not in self.currently_online_members:
-                        logging.info("A new user connected to the server: Name='{}', Status='{}', ID='{}', Server='{}'".format(member.name, member.status, member_id, member.server))
-                        newOnlineMembers[member_id] = member
+    @asyncio.coroutine
+    def run_sweep_lane(self, server, lane):
+        """ checks the members of lane until the lane is empty or the time budget for
+        checking them is used up (applying the role changes does not count). The
+        circuit breaker sees the checked members and removals of the whole pass """
+        if len(lane) == 0:
+            yield from self.start_sweep_pass(server, lane)
+
+        # role changes are planned first and applied afterwards
+        start = time.monotonic()
+        role_changes = []
+        unknown_roles = set()
+
+        while len(lane) > 0 and time.monotonic() - start < self.role_sync_pass_budget:
+            member_id = lane.pop()
+            member = server.get_member(member_id)
+            if member is None or member.id == self.user.id:
+                continue  # skip own bot user and members that left
+
+            is_new = member_id not in self.currently_online_members
+            self.currently_online_members[member_id] = member
+            lane.checked += 1
+
+            change, unknown = yield from self.check_member(member, is_new, lane.group_roles.get(member_id, []))
+            if change is not None:
+                role_changes.append(change)
+                if len(change.removed) > 0:
+                    lane.removals += 1
+            unknown_roles.update(unknown)
+
+        # one replace_roles call per member whose roles differ
+        yield from self.role_reconciler.apply(role_changes, lane.checked, len(server.members), lane.removals)
+        yield from self.report_unknown_roles(unknown_roles)
+
+        if len(lane) == 0:
+            lane.finish_pass(time.monotonic())
+        else:
+            logging.info("%s lane: time budget used up, %d members left for the next pass", lane.name, len(lane))
 
-                        # this user just got online and is not authed! ask this user to auth
-                        try:
-                            yield from self.send_message(member,
-                                                         """Hi! You need to authenticate to be able to use this Discord server. Please go to {} to obtain your authorization token (starting with auth=), and then just message the full token (including auth=) to me!""".format(self.auth_website))
-                        except:
-                            logging.info("Got an error while sending message to new user: " + sys.exc_info()[0])
+    def verify_users(self, server):
+        """ verify that groups of all users are valid, in two lanes: online members
+        every role_sync_full_interval seconds, offline members every
+        role_sync_offline_interval seconds """
+        logging.info("Start loop: Verifying roles of users")
 
+        while self.do_verify_users:
+            for lane in [self.fast_lane, self.slow_lane]:
+                if lane.is_due(time.monotonic()):
+                    try:
+                        yield from self.run_sweep_lane(server, lane)
+                    except asyncio.CancelledError:
+                        raise
+                    except:
+                        logging.error("Caught an exception in verify_users (%s lane)", lane.name, exc_info=True)
+                        lane.finish_pass(time.monotonic())
+
+            yield from asyncio.sleep(get_sweep_delay([self.fast_lane, self.slow_lane], time.monotonic()))
+            # end while
+    # end everify users
 
-                        yield from self.send_to_debug_channel("Non authed user {} just connected, asking user to auth...".format(member.name))
-                    else:
-                        # this user has been online for some time, no need to ask to auth again (I guess)
-                        logging.info("Waiting on auth for user: Name='%s', Status='%s', ID='%s', Server='%s'",member.name, member.status, member_id, member.server)
+    def reconcile_members(self, server):
+        """ reconciles the members in the reconcile queue (see on_member_join,
+        on_member_update and handle_auth_token). Every role_sync_db_interval seconds
+        the members whose discord_auth rows changed are added as well """
+        logging.info("Start loop: Reconciling changed members")
 
-            # now each member that has been in currently_online_members needs to be checked if still online
-            for member_id in self.currently_online_members.keys():
-                if member_id not in allOnlineMembers:
-                    member = self.currently_online_members[member_id]
-                    logging.info("Member %s went offline!", member.name)
+        last_sync = None
 
-            self.currently_online_members = allOnlineMembers
+        while True:
+            try:
+                if last_sync is None:
+                    timeout = self.role_sync_db_interval
+                else:
+                    timeout = max(last_sync + self.role_sync_db_interval - time.monotonic(), 0)
+                member_ids = yield from self.reconcile_queue.get(timeout)
+
+                # events do not sync discord_auth, that happens at most every role_sync_db_interval seconds
+                if last_sync is None or time.monotonic() - last_sync >= self.role_sync_db_interval:
+                    last_sync = time.monotonic()
+                    changed_ids = yield from self.sync_authed_members()
+                    member_ids = member_ids + [member_id for member_id in changed_ids if member_id not in member_ids]
+
+                if len(member_ids) > 0:
+                    yield from self.reconcile_member_ids(server, member_ids)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Caught an exception in reconcile_members", exc_info=True)
+                yield from asyncio.sleep(5)
 
-            yield from asyncio.sleep(30)
-            # end while
-    # end everify users
+    @asyncio.coroutine
+    def reconcile_member_ids(self, server, member_ids):
+        """ checks and applies the roles of the given members of server. The roles of
+        the authed members are resolved with one (chunked) query """
+        authed_ids = set([member_id for member_id in member_ids if member_id in self.authed_users])
+        group_roles = {}
+        if len(authed_ids) > 0:
+            group_roles = yield from self.model.get_roles_for_members(authed_ids)
+
+        role_changes = []
+        unknown_roles = set()
+        for member_id in member_ids:
+            member = server.get_member(member_id)
+            if member is None or member.id == self.user.id:
+                continue
+
+            is_new = member_id not in self.currently_online_members
+            self.currently_online_members[member_id] = member
+
+            # members that authed during the query are queried by check_member
+            member_roles = group_roles.get(member_id, []) if member_id in authed_ids else None
+            change, unknown = yield from self.check_member(member, is_new, member_roles)
+            if change is not None:
+                role_changes.append(change)
+            unknown_roles.update(unknown)
+
+        yield from self.role_reconciler.apply(role_changes, len(member_ids), len(server.members))
+        yield from self.report_unknown_roles(unknown_roles)
+
+    def schedule_ping_windows(self, server):
+        """ reconciles the members whose ping window opens or closes right at every
+        UTC hour change (see PingWindowWheel) """
+        logging.info("Start loop: Scheduling time dependent roles")
+
+        while True:
+            now = datetime.utcnow()
+            next_hour = (now.hour + 1) % 24
+            # wake up shortly after the hour changed
+            delay = 3600 - now.minute * 60 - now.second - now.microsecond / 1000000.0 + 0.5
+            yield from asyncio.sleep(delay)
+
+            try:
+                member_ids = self.ping_window_wheel.get_members(next_hour)
+                logging.info("Hour %d: ping windows of %d members opened or closed", next_hour, len(member_ids))
+                if len(member_ids) > 0:
+                    yield from self.reconcile_member_ids(server, member_ids)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Caught an exception in schedule_ping_windows", exc_info=True)
+
+    @asyncio.coroutine
+    def on_member_join(self, member):
+        """ a new member joined a server """
+        if self.main_server is not None and member.server == self.main_server:
+            self.reconcile_queue.add(member.id)
+
+    @asyncio.coroutine
+    def on_member_update(self, before, after):
+        """ roles, status, nick, ... of a member changed """
+        if self.main_server is None or after.server != self.main_server:
+            return
+        if set(before.roles) != set(after.roles) or before.status != after.status:
+            self.reconcile_queue.add(after.id)
+
+
+    @asyncio.coroutine
+    def send_message(self, destination, content, priority=PRIORITY_COMMAND, wait=True):
+        """ queues a message in the outbound dispatcher. With wait, this returns the
+        sent message (or raises the error of the send), otherwise it returns at once """
+        future = self.dispatcher.enqueue(destination, content, priority)
+        if not wait:
+            # the dispatcher logs errors
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return None
+        result = yield from future
+        return result
+
+    @asyncio.coroutine
+    def send_message_now(self, destination, content):
+        """ sends a message right away (used by the dispatcher) """
+        result = yield from super(MyDiscordBotClient, self).send_message(destination, content)
+        return result
+
+    @asyncio.coroutine
+    def send_auth_prompt(self, member):
+        """ asks member to auth (see AuthPrompter) """
+        yield from self.send_message(member,
+                                     """Hi! You need to authenticate to be able to use this Discord server. Please go to {} to obtain your authorization token (starting with auth=), and then just message the full token (including auth=) to me!""".format(self.auth_website),
+                                     priority=PRIORITY_AUTH)
+
+    def should_ask_to_auth(self, member_id):
+        """ False if member_id authed or left in the meantime """
+        return member_id not in self.authed_users and self.main_server is not None \
+            and self.main_server.get_member(member_id) is not None
+
+    @asyncio.coroutine
+    def send_to_debug_channel(self, msg, immediate=False):
+        """ sends a message to the debug channel, with the next digest of the debug
+        sink or (immediate) right away """
+        if immediate:
+            yield from self.debug_sink.send_now(msg)
+        else:
+            self.debug_sink.add_message(msg)
+
+    @asyncio.coroutine
+    def send_debug_error(self, msg):
+        """ sends an error to the debug channel right away """
+        yield from self.send_to_debug_channel(msg, immediate=True)
 
+    def debug_event(self, summary, item):
+        """ adds an event to the next digest, see DebugSink.add_event """
+        self.debug_sink.add_event(summary, item)
 
     @asyncio.coroutine
-    def send_to_debug_channel(self, msg):
-        """ sends a message to the debug channel """
-        yield from self.send_message(self.debug_channel, "DEBUG: " + msg)
+    def send_debug_digest(self, msg, immediate=False):
+        """ queues a digest of the debug sink in the dispatcher. Immediate messages
+        (errors, held role changes, ...) are sent as alerts, which are never dropped """
+        if self.debug_channel is None:
+            logging.info("No debug channel for: %s", msg)
+            return
+        priority = PRIORITY_ALERT if immediate else PRIORITY_DEBUG
+        yield from self.send_message(self.debug_channel, msg, priority=priority, wait=False)
 
 
     @asyncio.coroutine
-    def send_to_fleetbot_channel(self, group, msg):
-        """ sends a message to a fleetbot channel """
-        if group in self.group_channels:
-            logging.info("send_to_fleetbot_channel: Sending to the following channels: " + str(self.group_channels[group]))
-            for channel in self.group_channels[group]:
-                logging.info("send_to_fleetbot_channel(" + str(group) + ", msg): channel = " + str(channel))
-                yield from self.send_message(channel, msg)
+    def send_to_channel_id(self, channel_id, msg):
+        """ sends a fleetbot message to the channel with channel_id """
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            raise discord.ClientException("Unknown channel " + str(channel_id))
+        yield from self.send_message(channel, msg, priority=PRIORITY_FLEET)
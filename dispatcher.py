@@ -0,0 +1,219 @@
+""" The outbound message queue of the bot: every message goes through one
+dispatcher, which sends by priority and keeps within discord's rate limits """
+
+import asyncio
+import collections
+import logging
+import sys
+import time
+
+from message_utils import MAX_MESSAGE_LENGTH
+
+
+# priority classes, lower is more important
+PRIORITY_FLEET = 0
+PRIORITY_ALERT = 1 # reports an operator has to see (errors, held role changes, dead letters)
+PRIORITY_AUTH = 2
+PRIORITY_COMMAND = 3
+PRIORITY_DEBUG = 4
+
+PRIORITY_NAMES = ["fleet", "alert", "auth", "command", "debug"]
+
+# what happens to a class when its queue is full: "reject" raises QueueFull (the
+# caller retries, e.g. the fleetbot outbox), "drop" drops the oldest message.
+# "merge" additionally appends messages to the last queued message for the same
+# destination, as long as it stays below the message length limit. "keep" has
+# no limit, its messages are never dropped
+QUEUE_POLICIES = [
+    ("reject", 1000),
+    ("keep", None),
+    ("reject", 500),
+    ("drop", 100),
+    ("merge", 50),
+]
+
+# discord allows about 5 messages per 5 seconds per channel and 50 requests per second
+ROUTE_RATE = 1.0
+ROUTE_BURST = 5
+GLOBAL_RATE = 50.0
+GLOBAL_BURST = 50
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    """ rate tokens per second, at most capacity tokens """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, now):
+        """ seconds until a token is available (0 if there is one) """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundDispatcher:
+    """ Queues messages by priority class and sends them as soon as the token
+    buckets of their destination (route) and the global bucket allow it. Messages
+    to the same destination are sent in order, different destinations in
+    parallel (at most max_in_flight) """
+
+    def __init__(self, send, max_in_flight=5):
+        self.send = send # coroutine send(destination, content)
+        self.max_in_flight = max_in_flight
+
+        self.queues = [collections.deque() for policy in QUEUE_POLICIES]
+        self.route_buckets = {} # destination id -> TokenBucket
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.busy_routes = set() # destinations with a message in flight
+        self.ready = asyncio.Event()
+
+        # statistics per priority class
+        self.dispatched = [0] * len(QUEUE_POLICIES)
+        self.sent = [0] * len(QUEUE_POLICIES)
+        self.dropped = [0] * len(QUEUE_POLICIES)
+        self.merged = [0] * len(QUEUE_POLICIES)
+        self.total_wait = [0.0] * len(QUEUE_POLICIES)
+        self.max_wait = [0.0] * len(QUEUE_POLICIES)
+
+    def enqueue(self, destination, content, priority):
+        """ queues a message and returns a future with the result of the send """
+        policy, max_size = QUEUE_POLICIES[priority]
+        queue = self.queues[priority]
+
+        if policy == "merge":
+            for item in reversed(queue):
+                if item['route'] == destination.id:
+                    if len(item['content']) + 1 + len(content) <= MAX_MESSAGE_LENGTH:
+                        item['content'] += "\n" + content
+                        self.merged[priority] += 1
+                        return item['future']
+                    break
+
+        if max_size is not None and len(queue) >= max_size:
+            if policy == "reject":
+                raise QueueFull("{} queue is full".format(PRIORITY_NAMES[priority]))
+            dropped = queue.popleft()
+            dropped['future'].set_result(None)
+            self.dropped[priority] += 1
+            logging.warning("Dispatcher: %s queue is full, dropped a message to %s",
+                            PRIORITY_NAMES[priority], dropped['route'])
+
+        item = {
+            'route': destination.id,
+            'destination': destination,
+            'content': content,
+            'priority': priority,
+            'enqueued': time.monotonic(),
+            'future': asyncio.Future()
+        }
+        queue.append(item)
+        self.ready.set()
+        return item['future']
+
+    def get_route_bucket(self, route):
+        if route not in self.route_buckets:
+            if len(self.route_buckets) > 1000:
+                # forget routes that have not been used for a while
+                now = time.monotonic()
+                for old_route in [r for r, bucket in self.route_buckets.items() if bucket.is_full(now)]:
+                    del self.route_buckets[old_route]
+            self.route_buckets[route] = TokenBucket(ROUTE_RATE, ROUTE_BURST)
+        return self.route_buckets[route]
+
+    def next_item(self, now):
+        """ removes and returns the most important message that may be sent now, or
+        None and the number of seconds until one may be sent (None: no message) """
+        if len(self.busy_routes) >= self.max_in_flight:
+            return None, None
+        delay = self.global_bucket.get_delay(now)
+        if delay > 0:
+            return None, delay
+
+        delay = None
+        for queue in self.queues:
+            blocked_routes = set() # keep the order of messages to the same destination
+            for item in queue:
+                route = item['route']
+                if route in self.busy_routes or route in blocked_routes:
+                    continue
+                route_delay = self.get_route_bucket(route).get_delay(now)
+                if route_delay == 0:
+                    queue.remove(item)
+                    return item, 0
+                blocked_routes.add(route)
+                if delay is None or route_delay < delay:
+                    delay = route_delay
+        return None, delay
+
+    @asyncio.coroutine
+    def deliver(self, item):
+        try:
+            result = yield from self.send(item['destination'], item['content'])
+            self.sent[item['priority']] += 1
+            if not item['future'].done():
+                item['future'].set_result(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Dispatcher: sending a %s message to %s failed: %s",
+                          PRIORITY_NAMES[item['priority']], item['route'], str(sys.exc_info()[0]))
+            if not item['future'].done():
+                item['future'].set_exception(e)
+        finally:
+            self.busy_routes.discard(item['route'])
+            self.ready.set()
+
+    @asyncio.coroutine
+    def run(self):
+        """ sends queued messages until cancelled """
+        while True:
+            now = time.monotonic()
+            item, delay = self.next_item(now)
+            if item is None:
+                self.ready.clear()
+                try:
+                    yield from asyncio.wait_for(self.ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = now - item['enqueued']
+            self.dispatched[item['priority']] += 1
+            self.total_wait[item['priority']] += wait
+            self.max_wait[item['priority']] = max(self.max_wait[item['priority']], wait)
+
+            self.global_bucket.consume(now)
+            self.get_route_bucket(item['route']).consume(now)
+            self.busy_routes.add(item['route'])
+            asyncio.async(self.deliver(item))
+
+    def get_stats_str(self):
+        stats_str = "{} in flight".format(len(self.busy_routes))
+        for priority, name in enumerate(PRIORITY_NAMES):
+            dispatched = self.dispatched[priority]
+            stats_str += "\n  {}: {} queued, {} sent, wait avg {:.0f} ms, max {:.0f} ms, {} merged, {} dropped".format(
+                name, len(self.queues[priority]), self.sent[priority],
+                1000 * self.total_wait[priority] / dispatched if dispatched > 0 else 0.0,
+                1000 * self.max_wait[priority], self.merged[priority], self.dropped[priority])
+        return stats_str
@@ -0,0 +1,317 @@
+""" Delivery of fleetbot pings (irc_ping_history) to discord channels """
+
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+import random
+import sys
+import time
+
+from message_utils import MAX_MESSAGE_LENGTH, split_lines
+
+
+def min_delay(delay, other_delay):
+    """ returns the smaller of two delays, delay may be None (nothing scheduled yet) """
+    if delay is None or other_delay < delay:
+        return other_delay
+    return delay
+
+
+def coalesce_pings(pings, limit=MAX_MESSAGE_LENGTH):
+    """ merges pings ("from: message" strings) for one channel into as few
+    "@everyone" messages as possible, each at most limit characters long """
+    prefix = "@everyone "
+    return [prefix + msg for msg in split_lines(pings, limit - len(prefix))]
+
+
+class AdaptivePoller:
+    """ Waits between two polls of irc_ping_history: min_interval right after
+    activity, backing off exponentially up to max_interval while idle. Optionally
+    listens on a UNIX socket, every connection ends the current wait at once """
+
+    def __init__(self, min_interval=1.0, max_interval=30.0, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = max_interval
+
+        self.wakeup = asyncio.Event()
+        self.server = None
+
+        self.polls = 0
+        self.pushes = 0
+
+    def update(self, found_messages):
+        """ adapts the interval to the result of the last poll """
+        self.polls += 1
+        if found_messages:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    @asyncio.coroutine
+    def wait(self):
+        """ waits for the current interval or until wake() is called """
+        try:
+            yield from asyncio.wait_for(self.wakeup.wait(), self.interval)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def handle_connection(self, reader, writer):
+        """ callback for connections to the notify socket """
+        self.pushes += 1
+        self.interval = self.min_interval
+        self.wake()
+        writer.close()
+
+    @asyncio.coroutine
+    def listen(self, path):
+        """ starts listening on the UNIX socket path (e.g., for the process that
+        writes irc_ping_history: ``socat /dev/null UNIX-CONNECT:path``) """
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = yield from asyncio.start_unix_server(self.handle_connection, path)
+        logging.info("Fleetbot: listening for notifications on %s", path)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def get_stats_str(self):
+        return "{} polls, {} notifications, interval {:.1f} s".format(self.polls, self.pushes, self.interval)
+
+
+class PingDeduplicator:
+    """ Suppresses pings whose normalized content was already forwarded within the
+    last window seconds. Remembers the content hashes per scope (a broadcast group
+    or a channel) in a bounded LRU """
+
+    def __init__(self, window=300, max_size=1000):
+        self.window = window
+        self.max_size = max_size
+        self.seen = collections.OrderedDict() # (scope, hash) -> time it was forwarded
+
+        self.suppressed = 0
+
+    @staticmethod
+    def get_hash(message):
+        """ hash of the message, ignoring case and whitespace """
+        normalized = " ".join(message.lower().split())
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    def is_duplicate(self, scope, message, pending):
+        """ returns True if message was forwarded to scope within the window or is in
+        pending (the keys of the current batch). Otherwise adds its key to pending
+        and returns False. The keys are only remembered by record(pending), once the
+        batch was stored """
+        key = (scope, PingDeduplicator.get_hash(message))
+
+        if key in pending or (key in self.seen and time.monotonic() - self.seen[key] < self.window):
+            self.suppressed += 1
+            return True
+
+        pending.add(key)
+        return False
+
+    def record(self, keys):
+        """ remembers keys (see is_duplicate) as forwarded now """
+        now = time.monotonic()
+        for key in keys:
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+        while len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+
+    def get_stats_str(self):
+        return "{} duplicates suppressed, {} hashes".format(self.suppressed, len(self.seen))
+
+
+class FleetbotOutbox:
+    """ Tracks every (message, channel) pair until it was sent to discord (at least
+    once delivery). Entries are stored in the discordbot_outbox table together with
+    the fleetbot watermark, delivered entries are deleted. Failed sends are retried
+    with a jittered exponential backoff and dead-lettered after max_attempts """
+
+    def __init__(self, model, send, report, max_attempts=5, retry_delay=5):
+        self.model = model
+        self.send = send # coroutine send(channel_id, message)
+        self.report = report # coroutine report(message), e.g. to the debug channel
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        # outbox id -> entry (dictionary with id, channel_id, message, attempts, next_attempt)
+        self.pending = collections.OrderedDict()
+        self.new_entries = asyncio.Event()
+
+        self.delivered = 0
+        self.retries = 0
+        self.dead_letters = 0
+        # channel id -> delivery latency statistics, see record_latency
+        self.latencies = {}
+
+    @staticmethod
+    def create_entry(entry_id, channel_id, message, attempts=0):
+        return {
+            'id': entry_id,
+            'channel_id': channel_id,
+            'message': message,
+            'attempts': attempts,
+            'next_attempt': 0,
+            'enqueued': time.monotonic()
+        }
+
+    @asyncio.coroutine
+    def load(self):
+        """ loads all pending entries (e.g., from before a restart), they are delivered
+        before entries that were enqueued in the meantime """
+        rows = yield from self.model.get_fleetbot_outbox()
+        pending = collections.OrderedDict()
+        for row in rows:
+            pending[row['id']] = FleetbotOutbox.create_entry(row['id'], row['channel_id'], row['message'], row['attempts'])
+        for entry in self.pending.values():
+            pending[entry['id']] = entry
+        self.pending = pending
+        logging.info("Fleetbot outbox: loaded %d pending entries", len(rows))
+
+    @asyncio.coroutine
+    def enqueue(self, entries, last_message_id):
+        """ stores entries (list of (channel_id, message)) and the new fleetbot
+        watermark in one transaction and wakes up the delivery """
+        entry_ids = yield from self.model.enqueue_fleetbot_outbox(entries, last_message_id)
+        for entry_id, entry in zip(entry_ids, entries):
+            self.pending[entry_id] = FleetbotOutbox.create_entry(entry_id, entry[0], entry[1])
+        if len(entry_ids) > 0:
+            self.new_entries.set()
+
+    def get_retry_delay(self, attempts):
+        """ exponential backoff with jitter """
+        return self.retry_delay * (2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+
+    @asyncio.coroutine
+    def deliver_channel(self, entries):
+        """ sends the entries of one channel in order and stops at the first failure.
+        Returns the list of delivered ids and the failed entry (or None) """
+        delivered_ids = []
+        for entry in entries:
+            try:
+                yield from self.send(entry['channel_id'], entry['message'])
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Fleetbot outbox: sending entry %d to channel %s failed (attempt %d): %s",
+                              entry['id'], entry['channel_id'], entry['attempts'] + 1, str(sys.exc_info()[0]))
+                return delivered_ids, entry
+
+            self.record_latency(entry['channel_id'], time.monotonic() - entry['enqueued'])
+            delivered_ids.append(entry['id'])
+            del self.pending[entry['id']]
+            self.delivered += 1
+        return delivered_ids, None
+
+    @asyncio.coroutine
+    def deliver(self):
+        """ sends all pending entries that are due. All channels are sent to at the
+        same time, the entries of a channel in order. Returns the number of seconds
+        until the next retry (or None) """
+        now = time.monotonic()
+        waiting_channels = set() # keep the order within a channel
+        entries_by_channel = collections.OrderedDict()
+        next_retry = None
+
+        for entry in list(self.pending.values()):
+            if entry['next_attempt'] > now:
+                waiting_channels.add(entry['channel_id'])
+                next_retry = min_delay(next_retry, entry['next_attempt'] - now)
+            elif entry['channel_id'] not in waiting_channels:
+                if entry['channel_id'] not in entries_by_channel:
+                    entries_by_channel[entry['channel_id']] = [entry]
+                else:
+                    entries_by_channel[entry['channel_id']].append(entry)
+
+        if len(entries_by_channel) == 0:
+            return next_retry
+
+        results = yield from asyncio.gather(*[self.deliver_channel(entries) for entries in entries_by_channel.values()])
+
+        delivered_ids = []
+        dead = []
+        for channel_delivered_ids, failed in results:
+            delivered_ids.extend(channel_delivered_ids)
+            if failed is None:
+                continue
+
+            failed['attempts'] += 1
+            if failed['attempts'] >= self.max_attempts:
+                del self.pending[failed['id']]
+                dead.append(failed)
+                self.dead_letters += 1
+            else:
+                delay = self.get_retry_delay(failed['attempts'])
+                failed['next_attempt'] = time.monotonic() + delay
+                next_retry = min_delay(next_retry, delay)
+                self.retries += 1
+            yield from self.model.update_fleetbot_outbox_attempts(failed['id'], failed['attempts'],
+                                                                  failed['attempts'] >= self.max_attempts)
+
+        if len(delivered_ids) > 0:
+            yield from self.model.ack_fleetbot_outbox(delivered_ids)
+
+        if len(dead) > 0:
+            summary = "Fleetbot: gave up on {} pings after {} attempts:".format(len(dead), self.max_attempts)
+            for entry in dead:
+                summary += "\n<#{}>: {}".format(entry['channel_id'], entry['message'][:100])
+            yield from self.report(summary)
+
+            # the entries behind the dead-lettered ones are due right away
+            next_retry = 0
+
+        return next_retry
+
+    def record_latency(self, channel_id, latency):
+        """ records the time between enqueueing and sending an entry to channel_id """
+        if channel_id not in self.latencies:
+            self.latencies[channel_id] = {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0}
+        stats = self.latencies[channel_id]
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['max'] = max(stats['max'], latency)
+        stats['last'] = latency
+
+    @asyncio.coroutine
+    def run(self):
+        """ delivers entries whenever new entries arrive or a retry is due """
+        loaded = False
+
+        while True:
+            self.new_entries.clear()
+            try:
+                if not loaded:
+                    yield from self.load()
+                    loaded = True
+                next_retry = yield from self.deliver()
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error("Fleetbot outbox: delivery failed", exc_info=True)
+                next_retry = self.retry_delay
+
+            try:
+                yield from asyncio.wait_for(self.new_entries.wait(), next_retry)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats_str(self):
+        stats_str = "{} pending, {} delivered, {} retries, {} dead-lettered".format(
+            len(self.pending), self.delivered, self.retries, self.dead_letters)
+        for channel_id in sorted(self.latencies.keys()):
+            stats = self.latencies[channel_id]
+            stats_str += "\n  <#{}>: {} sent, latency avg {:.0f} ms, max {:.0f} ms, last {:.0f} ms".format(
+                channel_id, stats['count'], 1000 * stats['total'] / stats['count'], 1000 * stats['max'], 1000 * stats['last'])
+        return stats_str
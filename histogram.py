@@ -0,0 +1,32 @@
+""" A small latency histogram for the statistics of the bot """
+
+
+class LatencyHistogram:
+    """ Counts latencies (in seconds) in buckets with the given upper bounds, plus
+    one bucket for everything above the last bound """
+
+    def __init__(self, bounds=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if latency <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def get_stats_str(self):
+        if self.count == 0:
+            return "no data"
+        buckets = ["<={:g}s: {}".format(bound, count) for bound, count in zip(self.bounds, self.counts)]
+        buckets.append(">{:g}s: {}".format(self.bounds[-1], self.counts[-1]))
+        return "{} samples, avg {:.0f} ms, max {:.0f} ms ({})".format(
+            self.count, 1000 * self.total / self.count, 1000 * self.max, ", ".join(buckets))
@@ -0,0 +1,57 @@
+""" Rules that decide which expensive killmails are posted to which channel """
+
+import logging
+
+
+class KillmailRule:
+    """ A compiled rule for one channel: minimum value and optional sets of region
+    IDs and ship group IDs """
+
+    def __init__(self, channel_name, min_value=2000000000, regions=None, ship_groups=None):
+        self.channel_name = channel_name
+        self.min_value = min_value
+        self.regions = regions # set of region IDs or None for all regions
+        self.ship_groups = ship_groups # set of ship group IDs or None for all ship groups
+
+    def matches(self, kill):
+        """ kill is a dictionary with value, region_id and ship_group_id """
+        if kill['value'] is None or kill['value'] < self.min_value:
+            return False
+        if self.regions is not None and kill['region_id'] not in self.regions:
+            return False
+        if self.ship_groups is not None and kill['ship_group_id'] not in self.ship_groups:
+            return False
+        return True
+
+    def __repr__(self):
+        return "KillmailRule({}, min_value={}, regions={}, ship_groups={})".format(
+            self.channel_name, self.min_value, self.regions, self.ship_groups)
+
+
+def parse_killmail_rules(rules_str):
+    """ parses killmail rules like
+    ``chan1->min_value=2000000000,chan2->min_value=500000000;region=10000060|10000039;ship_group=30``
+    into a list of KillmailRule. A channel may have several rules """
+    rules = []
+    if rules_str.strip() == "":
+        return rules
+
+    for rule_str in rules_str.split(","):
+        channel_name, conditions = (rule_str.split("->") + [""])[:2]
+        rule = KillmailRule(channel_name.strip())
+        for condition in conditions.split(";"):
+            if condition.strip() == "":
+                continue
+            key, value = condition.split("=")
+            key = key.strip()
+            if key == "min_value":
+                rule.min_value = float(value)
+            elif key == "region":
+                rule.regions = set(int(region) for region in value.split("|"))
+            elif key == "ship_group":
+                rule.ship_groups = set(int(group) for group in value.split("|"))
+            else:
+                logging.error("Unknown killmail rule condition '%s' for channel %s", key, channel_name)
+        logging.info("Parsed %s", rule)
+        rules.append(rule)
+    return rules
@@ -0,0 +1,31 @@
+""" Helpers for building discord messages """
+
+# discord does not accept messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_lines(lines, limit=MAX_MESSAGE_LENGTH):
+    """ joins lines with newlines into as few messages as possible, each at most
+    limit characters long. Lines that are longer than limit are split """
+    messages = []
+    current = ""
+
+    for line in lines:
+        while len(line) > limit:
+            if current != "":
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+
+        if current == "":
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            messages.append(current)
+            current = line
+
+    if current != "":
+        messages.append(current)
+    return messages
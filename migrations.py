@@ -0,0 +1,167 @@
+""" Schema migrations of the bot: creates its own tables, adds missing columns and
+the indexes that the frequent queries of model.py rely on, and checks the query
+plans of those queries with EXPLAIN """
+
+import logging
+
+from model import ROLES_FOR_MEMBER_SQL, CHANGED_AUTHED_MEMBERS_SQL, FLEETBOT_MESSAGES_SQL, \
+    ITEM_PRICE_SQL, get_expensive_killmails_sql
+
+
+# tables owned by the bot
+TABLES = [
+    ("discordbot_state", """CREATE TABLE IF NOT EXISTS discordbot_state (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    value VARCHAR(255) NOT NULL
+    )"""),
+    ("discordbot_outbox", """CREATE TABLE IF NOT EXISTS discordbot_outbox (
+    id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    channel_id VARCHAR(32) NOT NULL,
+    message TEXT NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    dead TINYINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_discordbot_outbox_dead (dead, id)
+    )"""),
+    ("discordbot_auth_prompts", """CREATE TABLE IF NOT EXISTS discordbot_auth_prompts (
+    member_id VARCHAR(32) NOT NULL PRIMARY KEY,
+    asked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )"""),
+]
+
+# (table, column, definition)
+COLUMNS = [
+    ("discord_auth", "updated_at", "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"),
+]
+
+# columns of other tables that some features need, they are only reported if missing
+# (table, column, feature)
+CHECKED_COLUMNS = [
+    ("kills_killmails", "solar_system_id", "killmail rules with region"),
+    ("kills_killmails", "ship_type_id", "killmail rules with ship_group"),
+]
+
+# (table, index name, columns). An index counts as present if any index of the
+# table (including the primary key) starts with these columns
+INDEXES = [
+    ("discord_auth", "idx_discord_auth_member_id", ["discord_member_id"]),
+    ("discord_auth", "idx_discord_auth_token", ["discord_auth_token"]),
+    ("discord_auth", "idx_discord_auth_updated_at", ["updated_at"]),
+    ("irc_ping_history", "idx_irc_ping_history_id", ["id"]),
+    ("prices", "idx_prices_type_id", ["type_id"]),
+    ("kills_killmails", "idx_kills_killmails_kill_time", ["kill_time"]),
+    ("kills_killmails", "idx_kills_killmails_external_kill_id", ["external_kill_ID"]),
+]
+
+# (name, query, example arguments, table aliases that must not be scanned completely)
+HOT_QUERIES = [
+    ("roles of a member", ROLES_FOR_MEMBER_SQL, ("0",), ["a"]),
+    ("changed authed members", CHANGED_AUTHED_MEMBERS_SQL, ("2038-01-01 00:00:00",), ["discord_auth"]),
+    ("fleetbot messages", FLEETBOT_MESSAGES_SQL, (0, 100), ["irc_ping_history"]),
+    ("item price", ITEM_PRICE_SQL, (34,), ["prices"]),
+    ("expensive killmails", get_expensive_killmails_sql(), (2000000000, 0, 50), ["k"]),
+]
+
+
+def get_columns(db, table):
+    """ returns the set of column names of table """
+    with db.cursor() as cursor:
+        sql = """SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"""
+        cursor.execute(sql, (table,))
+        columns = set([row['COLUMN_NAME'].lower() for row in cursor])
+        cursor.close()
+        return columns
+
+
+def get_indexes(db, table):
+    """ returns a dictionary which maps every index name of table to its list of columns """
+    with db.cursor() as cursor:
+        sql = """SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX"""
+        cursor.execute(sql, (table,))
+        indexes = {}
+        for row in cursor:
+            indexes.setdefault(row['INDEX_NAME'], []).append(row['COLUMN_NAME'].lower())
+        cursor.close()
+        return indexes
+
+
+def has_index(indexes, columns):
+    """ True if one of indexes (see get_indexes) starts with columns """
+    columns = [column.lower() for column in columns]
+    for index_columns in indexes.values():
+        if index_columns[:len(columns)] == columns:
+            return True
+    return False
+
+
+def migrate(db, apply=True):
+    """ creates the tables of the bot and adds missing columns and indexes. If apply
+    is False, nothing is changed and missing columns and indexes are only reported.
+    Returns a list of warnings """
+    warnings = []
+
+    if apply:
+        with db.cursor() as cursor:
+            for table, sql in TABLES:
+                cursor.execute(sql)
+            cursor.close()
+        db.commit()
+
+    for table, column, definition in COLUMNS:
+        if column.lower() in get_columns(db, table):
+            continue
+        if not apply:
+            warnings.append("Column {}.{} is missing".format(table, column))
+            continue
+        logging.info("Migration: adding column %s.%s", table, column)
+        with db.cursor() as cursor:
+            cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+            cursor.close()
+
+    for table, column, feature in CHECKED_COLUMNS:
+        if column.lower() not in get_columns(db, table):
+            warnings.append("Column {}.{} is missing, {} will not work".format(table, column, feature))
+
+    for table, index_name, columns in INDEXES:
+        if has_index(get_indexes(db, table), columns):
+            continue
+        if not apply:
+            warnings.append("Index on {}({}) is missing".format(table, ", ".join(columns)))
+            continue
+        logging.info("Migration: adding index %s on %s(%s)", index_name, table, ", ".join(columns))
+        with db.cursor() as cursor:
+            cursor.execute("ALTER TABLE {} ADD INDEX {} ({})".format(table, index_name, ", ".join(columns)))
+            cursor.close()
+
+    return warnings
+
+
+def check_query_plans(db):
+    """ runs EXPLAIN for every query in HOT_QUERIES and returns a list of warnings
+    for queries that read one of their checked tables completely (type ALL) """
+    warnings = []
+    with db.cursor() as cursor:
+        for name, sql, args, checked_tables in HOT_QUERIES:
+            cursor.execute("EXPLAIN " + sql, args)
+            for row in cursor:
+                if row['table'] in checked_tables and row['type'] == 'ALL':
+                    warnings.append("Query '{}' scans table {} completely (about {} rows)".format(
+                        name, row['table'], row['rows']))
+        cursor.close()
+    return warnings
+
+
+def run(db, apply=True, explain=True):
+    """ runs the migrations and the query plan checks and logs all warnings """
+    warnings = migrate(db, apply)
+    if explain:
+        warnings += check_query_plans(db)
+
+    for warning in warnings:
+        logging.warning("Schema: %s", warning)
+    if len(warnings) == 0:
+        logging.info("Schema: all tables, columns and indexes are in place")
+    return warnings
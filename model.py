@@ -2,48 +2,207 @@ import pymysql
 import pymysql.cursors
 import pymysql.connections
 
+import asyncio
+import contextlib
+import functools
 import logging
+import queue
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+from staticdata import SolarSystemIndex, ItemIndex
+
+
+# queries that run very often; migrations.py makes sure that they can use an index
+ROLES_FOR_MEMBER_SQL = """SELECT discord_group_id
+    FROM groups g, group_membership m, discord_auth a
+    WHERE a.discord_member_id=%s AND g.group_id = m.group_id
+    AND m.state <= 1
+    AND m.user_id = a.user_id AND g.discord_group_id != 0"""
+
+# use >= so rows updated within the same second as the watermark are not lost
+CHANGED_AUTHED_MEMBERS_SQL = """SELECT user_id, discord_member_id, discord_auth_token,
+    ping_start_hour, ping_stop_hour, updated_at
+    FROM discord_auth
+    WHERE updated_at >= %s
+    ORDER BY updated_at ASC"""
+
+FLEETBOT_MESSAGES_SQL = """SELECT id, from_character, `timestamp`, message, groupname
+    FROM irc_ping_history WHERE id > %s ORDER BY id ASC LIMIT %s"""
+
+ITEM_PRICE_SQL = """SELECT sell FROM prices WHERE type_id=%s"""
+
+# kill_time is compared with a constant (instead of TIMESTAMPDIFF(HOUR, kill_time, now()) < 3),
+# so the index on kill_time can be used
+EXPENSIVE_KILLMAILS_SQL = """SELECT k.external_kill_ID, k.zkb_total_value{columns}
+    FROM kills_killmails k{joins}
+    WHERE k.zkb_total_value > %s AND k.external_kill_ID > %s
+    AND k.kill_time > NOW() - INTERVAL 3 HOUR
+    ORDER BY k.external_kill_ID ASC
+    LIMIT %s"""
+
+# only needed for killmail rules with regions or ship groups, see get_expensive_killmails_sql
+KILLMAIL_REGION_JOIN = """
+    LEFT JOIN eve_staticdata.mapSolarSystems s ON s.solarSystemID = k.solar_system_id"""
+KILLMAIL_SHIP_GROUP_JOIN = """
+    LEFT JOIN eve_staticdata.invTypes t ON t.typeID = k.ship_type_id"""
+
+
+def get_expensive_killmails_sql(with_regions=False, with_ship_groups=False):
+    """ returns EXPENSIVE_KILLMAILS_SQL, with the joins for the region and the ship group
+    of the kills if they are needed (they use kills_killmails.solar_system_id and ship_type_id) """
+    columns = ""
+    joins = ""
+    if with_regions:
+        columns += ", s.regionID"
+        joins += KILLMAIL_REGION_JOIN
+    if with_ship_groups:
+        columns += ", t.groupID"
+        joins += KILLMAIL_SHIP_GROUP_JOIN
+    return EXPENSIVE_KILLMAILS_SQL.format(columns=columns, joins=joins)
+
+
+class ConnectionPool:
+    """ A bounded pool of pymysql connections. Connections are created lazily by
+    calling connect(), which should open them with autocommit, so every read sees
+    the latest data (methods with several writes use begin() and commit()). A
+    connection is only checked (and reconnected) after an OperationalError """
+
+    def __init__(self, connect, size=4):
+        self.connect = connect # callable that returns a new pymysql connection
+        self.size = size
+        self.connections = queue.Queue(maxsize=size)
+
+        for i in range(0, size):
+            self.connections.put(None)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ borrows a connection from the pool, blocks until one is available """
+        db = self.connections.get()
+        try:
+            if db is None:
+                db = self.connect()
+            yield db
+        except pymysql.OperationalError:
+            # e.g., the server closed the idle connection: reconnect for the next query
+            if db is not None:
+                try:
+                    db.ping(reconnect=True)
+                except pymysql.Error:
+                    logging.error("Reconnect failed, dropping database connection")
+                    db = None
+            raise
+        except:
+            if db is not None:
+                try:
+                    db.rollback()
+                except pymysql.Error:
+                    logging.error("Rollback failed, dropping database connection")
+                    db = None
+            raise
+        finally:
+            self.connections.put(db)
+
+    def close(self):
+        """ closes all connections that are currently idle in the pool """
+        for i in range(0, self.size):
+            db = self.connections.get()
+            if db is not None:
+                try:
+                    db.close()
+                except pymysql.Error:
+                    pass
+            self.connections.put(None)
+
+
+def threaded_query(func):
+    """ Turns a blocking MyDBModel method into a coroutine. The method is executed
+    on the thread pool of the model and gets a connection from the connection pool
+    as its first argument (after self) """
+    @functools.wraps(func)
+    @asyncio.coroutine
+    def wrapper(self, *args):
+        loop = asyncio.get_event_loop()
+        result = yield from loop.run_in_executor(self.executor,
+                                                 functools.partial(self.run_with_connection, func, *args))
+        return result
+    return wrapper
 
-class MyDBModel:
-    """ Database model which holds several get / set methods"""
-
-    def __init__(self, db):
-        self.db = db # the database
-
-    def check_db_connection(self):
-        sq = "SELECT NOW()"
-        with self.db.cursor() as cursor:
-            try:
-                cursor.execute( sq )
-            except pymysql.Error as e:
-                if e.errno == 2006:
-                    logging.error("Database connection failed, trying to reconnect")
-                    return self.db.connect()
-                else:
-                    logging.error("Database connection failed... could not connect to database...")
-                    return False
-
-    def set_discord_member_id_for_auth_code(self, auth_code, member_id):
-        """ establish relation ship between discord member and auth token"""
-        logging.debug("set_discord_member_id_for_auth_code({}, {})". format(auth_code, member_id))
 
-        with self.db.cursor() as cursor:
-            # Read a single record
+class MyDBModel:
+    """ Database model which holds several get / set methods.
+    All public methods are coroutines, the queries run on a thread pool """
+
+    def __init__(self, pool, price_cache_size=50000, price_cache_ttl=1800):
+        self.pool = pool # the database connection pool
+        # one worker per connection, so a worker never waits on the pool
+        self.executor = ThreadPoolExecutor(max_workers=pool.size)
+
+        # item prices by type id, see get_item_price and refresh_prices
+        self.price_cache = TTLCache(price_cache_size, price_cache_ttl)
+
+        # in-memory indexes over the static data, see load_static_data
+        self.system_index = None
+        self.item_index = None
+
+    def run_with_connection(self, func, *args):
+        """ runs func(self, db, *args) with a connection from the pool (blocking) """
+        with self.pool.connection() as db:
+            return func(self, db, *args)
+
+    def close(self):
+        """ stops the thread pool and closes all database connections """
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    @threaded_query
+    def claim_auth_token(self, db, auth_code, member_id):
+        """ establishes the relationship between discord member and auth token, if the
+        token exists and was not claimed yet. Everything happens in one transaction.
+        Returns None for an invalid token, otherwise a dictionary with the authed
+        member (see authed_member_from_row), character_name, corp_name, character_id
+        and the discord group IDs (roles) of the member """
+        db.begin()
+        with db.cursor() as cursor:
             sql = "UPDATE discord_auth SET discord_member_id = %s WHERE discord_auth_token=%s AND discord_member_id = '' "
+            number = cursor.execute(sql, (member_id, auth_code,))
+            if number != 1:
+                logging.error("Auth token '%s' not found or already claimed (%d rows)", auth_code, number)
+                cursor.close()
+                db.rollback()
+                return None
+
+            sql = """SELECT a.user_id, a.discord_auth_token, a.ping_start_hour, a.ping_stop_hour,
+            c.corp_name, c.character_name, c.character_id
+            FROM discord_auth a
+            LEFT JOIN auth_users b ON b.user_id = a.user_id
+            LEFT JOIN api_characters c ON c.user_id = b.user_id AND c.character_id = b.has_regged_main
+            WHERE a.discord_member_id = %s AND a.discord_auth_token = %s"""
             cursor.execute(sql, (member_id, auth_code,))
+            row = cursor.fetchone()
+
+            cursor.execute(ROLES_FOR_MEMBER_SQL, (member_id,))
+            roles = [str(role_row['discord_group_id']) for role_row in cursor]
             cursor.close()
-            self.db.commit()
+            db.commit()
 
+            return {
+                'authed_member': self.authed_member_from_row(row),
+                'character_name': row['character_name'] if row['character_name'] is not None else "Unknown",
+                'corp_name': row['corp_name'] if row['corp_name'] is not None else "Unknown",
+                'character_id': row['character_id'] if row['character_id'] is not None else -1,
+                'roles': roles
+            }
+        return None
 
-    def get_roles_for_member(self, member_id):
+
+    @threaded_query
+    def get_roles_for_member(self, db, member_id):
         """ returns an array of discord group IDs for a certain member """
-        with self.db.cursor() as cursor:
-            sql = """SELECT discord_group_id
-            FROM groups g, group_membership m, discord_auth a
-            WHERE a.discord_member_id=%s AND g.group_id = m.group_id
-            AND m.state <= 1
-            AND m.user_id = a.user_id AND g.discord_group_id != 0"""
-            cursor.execute(sql, (member_id,))
+        with db.cursor() as cursor:
+            cursor.execute(ROLES_FOR_MEMBER_SQL, (member_id,))
 
             roles = []
             for row in cursor:
@@ -54,27 +213,60 @@ class MyDBModel:
         return []
 
 
-    def is_auth_code_in_table(self, auth_code):
-        with self.db.cursor() as cursor:
-            # Read a single record
-            sql = "SELECT COUNT(*) as cnt_authed from discord_auth WHERE discord_auth_token=%s AND discord_member_id = '' "
-            cursor.execute(sql, (auth_code,))
-            result = cursor.fetchone()
-            retval = False
-            if result['cnt_authed'] == 1 or result['cnt_authed'] == "1":
-                retval = True
-            else:
-                logging.error("Auth name not found? cnt_authed=" + str(result['cnt_authed']))
-                logging.error("auth_code='" + auth_code + "'")
+    @threaded_query
+    def get_roles_for_all_members(self, db):
+        """ returns a dictionary which maps the member id of every authed member to an
+        array of discord group IDs, using a single query """
+        with db.cursor() as cursor:
+            sql = """SELECT a.discord_member_id, g.discord_group_id
+            FROM groups g, group_membership m, discord_auth a
+            WHERE g.group_id = m.group_id
+            AND m.state <= 1
+            AND m.user_id = a.user_id AND g.discord_group_id != 0
+            AND a.discord_auth_token <> ''
+            AND a.discord_member_id IS NOT NULL"""
+            cursor.execute(sql)
+
+            roles_by_member = {}
+            for row in cursor:
+                member_id = str(row['discord_member_id'])
+                if member_id not in roles_by_member:
+                    roles_by_member[member_id] = []
+                roles_by_member[member_id].append(str(row['discord_group_id']))
+            cursor.close()
+            return roles_by_member
+        return {}
+
+    @threaded_query
+    def get_roles_for_members(self, db, member_ids, chunk_size=500):
+        """ like get_roles_for_all_members, but only for the given member ids (one query
+        per chunk_size members). Members without roles are not in the dictionary """
+        roles_by_member = {}
+        member_ids = list(member_ids)
+        with db.cursor() as cursor:
+            for start in range(0, len(member_ids), chunk_size):
+                chunk = member_ids[start:start + chunk_size]
+                sql = """SELECT a.discord_member_id, g.discord_group_id
+                FROM groups g, group_membership m, discord_auth a
+                WHERE g.group_id = m.group_id
+                AND m.state <= 1
+                AND m.user_id = a.user_id AND g.discord_group_id != 0
+                AND a.discord_member_id IN (""" + ", ".join(["%s"] * len(chunk)) + ")"
+                cursor.execute(sql, tuple(chunk))
+
+                for row in cursor:
+                    member_id = str(row['discord_member_id'])
+                    if member_id not in roles_by_member:
+                        roles_by_member[member_id] = []
+                    roles_by_member[member_id].append(str(row['discord_group_id']))
             cursor.close()
-            return retval
-        logging.error("is_auth_code_in_table: outside of where we should be...")
-        return False
+        return roles_by_member
 
 
-    def get_discord_members_number_of_kills(self, member_id):
+    @threaded_query
+    def get_discord_members_number_of_kills(self, db, member_id):
         """ returns characters name, corporation name, character id based on the member id"""
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             sql = """SELECT SUM(s.number_kills) as number_kills
             FROM discord_auth a, auth_users b, api_characters c, kills_stats_per_char s
             WHERE a.user_id = b.user_id AND b.user_id = c.user_id AND c.character_id = s.character_id
@@ -88,9 +280,10 @@ class MyDBModel:
         return 0
 
 
-    def get_discord_members_character_id(self, member_id):
+    @threaded_query
+    def get_discord_members_character_id(self, db, member_id):
         """ returns characters name, corporation name, character id based on the member id"""
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             sql = """SELECT c.corp_name, c.character_name, c.character_id from discord_auth a, auth_users b, api_characters c
             WHERE a.user_id = b.user_id AND b.user_id = c.user_id AND c.character_id = b.has_regged_main
             AND a.discord_member_id = %s"""
@@ -103,18 +296,24 @@ class MyDBModel:
         return "Unknown", -1, -1
 
 
-    def get_all_authed_members(self):
-        """ returns a list of all authed members as dictionaries """
-        self.check_db_connection()
-
-        with self.db.cursor() as cursor:
-            # first, delete all "pending auth users"
+    @threaded_query
+    def delete_pending_auth_members(self, db):
+        """ deletes all "pending auth users" from discord_auth """
+        with db.cursor() as cursor:
             sql = """DELETE FROM discord_auth WHERE discord_auth_token = ''"""
-            cursor.execute(sql)
-            self.db.commit()
+            number = cursor.execute(sql)
+            cursor.close()
+            db.commit()
+            return number
+        return 0
 
+    @threaded_query
+    def get_all_authed_members(self, db):
+        """ returns a dictionary of all authed members (as dictionaries) and the
+        highest updated_at value, which is the watermark for get_changed_authed_members """
+        with db.cursor() as cursor:
             sql = """SELECT user_id, discord_member_id, discord_auth_token,
-            ping_start_hour, ping_stop_hour
+            ping_start_hour, ping_stop_hour, updated_at
             FROM discord_auth
             WHERE discord_auth_token <> ''
             AND discord_member_id  IS NOT NULL; """
@@ -122,44 +321,82 @@ class MyDBModel:
             cursor.execute(sql)
 
             authed_users = {}
+            watermark = None
 
             for row in cursor:
-                authed_users[str(row['discord_member_id'])] = {
-                    'user_id': row['user_id'],
-                    'auth_token': row['discord_auth_token'],
-                    'start_hour': row['ping_start_hour'],
-                    'stop_hour': row['ping_stop_hour']
-                }
+                authed_users[str(row['discord_member_id'])] = self.authed_member_from_row(row)
+                if watermark is None or row['updated_at'] > watermark:
+                    watermark = row['updated_at']
             cursor.close()
 
-            return authed_users
-        return {}
+            return authed_users, watermark
+        return {}, None
+
+    @threaded_query
+    def get_changed_authed_members(self, db, watermark):
+        """ returns the rows of discord_auth that changed since watermark (updated_at)
+        as a dictionary by member id and the new watermark. Members that are no
+        longer authed map to None """
+        with db.cursor() as cursor:
+            cursor.execute(CHANGED_AUTHED_MEMBERS_SQL, (watermark,))
+
+            changed_users = {}
+
+            for row in cursor:
+                if row['discord_member_id'] is None:
+                    continue
+                member_id = str(row['discord_member_id'])
+                if row['discord_auth_token'] != '':
+                    changed_users[member_id] = self.authed_member_from_row(row)
+                else:
+                    changed_users[member_id] = None
+                if row['updated_at'] > watermark:
+                    watermark = row['updated_at']
+            cursor.close()
 
-    def update_ping_start_stop_hour(self, discord_member_id, start_hour, stop_hour):
+            return changed_users, watermark
+        return {}, watermark
+
+    @staticmethod
+    def authed_member_from_row(row):
+        """ converts a row of discord_auth into the dictionary used for authed members """
+        return {
+            'user_id': row['user_id'],
+            'auth_token': row['discord_auth_token'],
+            'start_hour': row['ping_start_hour'],
+            'stop_hour': row['ping_stop_hour']
+        }
+
+    @threaded_query
+    def update_ping_start_stop_hour(self, db, discord_member_id, start_hour, stop_hour):
         """ updates discord_auth.ping_start_hour and ping_stop_hour """
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             sql = """UPDATE discord_auth SET ping_start_hour = %s, ping_stop_hour = %s
             WHERE discord_member_id = %s"""
 
             cursor.execute(sql, (str(start_hour), str(stop_hour), str(discord_member_id),))
             cursor.close()
 
-            self.db.commit()
+            db.commit()
 
-    def get_fleetbot_max_message_id(self):
+    @threaded_query
+    def get_fleetbot_max_message_id(self, db):
         """ returns the last max message id from fleetbot messages """
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             sql = """SELECT max(id) as max_id FROM irc_ping_history """
             cursor.execute(sql)
 
             row = cursor.fetchone()
             max_id = row['max_id']
 
+            if max_id is None: # no messages yet
+                return 0
             return max_id
         return 0
 
 
-    def find_pos(self, solar_system_id=None):
+    @threaded_query
+    def find_pos(self, db, solar_system_id=None):
         """ Returns a list of POSes in that system """
 
         sql = """select s.itemID, s.typeID, pos_state, d.itemName, i.typeName, a.quantity
@@ -175,7 +412,7 @@ class MyDBModel:
         if solar_system_id != None:
             sql += " AND s.locationID = " + str(solar_system_id)
 
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             number = cursor.execute(sql)
             starbases = {}
             if number > 0:
@@ -192,13 +429,60 @@ class MyDBModel:
                 return {}
 
 
+    @threaded_query
+    def get_all_solar_systems(self, db):
+        """ Returns a list of all solar systems with their region """
+        sql = """SELECT regionName, solarSystemID, solarSystemName
+            FROM eve_staticdata.mapSolarSystems s, eve_staticdata.mapRegions r
+            WHERE r.regionID = s.regionID"""
+        with db.cursor() as cursor:
+            cursor.execute(sql)
+            systems = []
+            for row in cursor:
+                systems.append({'regionName': row['regionName'], 'solarSystemID': row['solarSystemID'],
+                                'solarSystemName': row['solarSystemName']})
+            cursor.close()
+            return systems
+
+    @asyncio.coroutine
+    def load_static_data(self):
+        """ Loads the static data indexes (solar systems, items), which are used instead of
+        querying eve_staticdata. The indexes are built on the thread pool, so the event
+        loop (e.g., the gateway heartbeat) is not blocked """
+        loop = asyncio.get_event_loop()
+        if self.system_index is None:
+            systems = yield from self.get_all_solar_systems()
+            self.system_index = yield from loop.run_in_executor(self.executor, SolarSystemIndex, systems)
+        if self.item_index is None:
+            items = yield from self.get_all_published_items()
+            self.item_index = yield from loop.run_in_executor(self.executor, ItemIndex, items)
+
+    @asyncio.coroutine
     def find_system(self, system_str):
+        """ Returns a system and region name based on system_str (partial), uses the
+        solar system index if it is loaded """
+        if self.system_index is not None:
+            return self.system_index.find(system_str)
+
+        result = yield from self.find_system_in_db(system_str)
+        return result
+
+    @asyncio.coroutine
+    def suggest_system(self, system_str):
+        """ Returns a list of systems with a name close to system_str (typos), empty
+        if the solar system index is not loaded """
+        if self.system_index is None:
+            return []
+        return self.system_index.suggest(system_str)
+
+    @threaded_query
+    def find_system_in_db(self, db, system_str):
         """ Returns a system and region name based on system_str (partial) """
         system_str = system_str + "%"
         sql = """SELECT regionName, solarSystemID, solarSystemName
             FROM eve_staticdata.mapSolarSystems s, eve_staticdata.mapRegions r
             WHERE r.regionID = s.regionID and `solarSystemName` LIKE %s"""
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             number = cursor.execute(sql, (system_str,))
             if number == 1:
                 result = cursor.fetchone()
@@ -214,11 +498,71 @@ class MyDBModel:
                 cursor.close()
                 return system_names
 
+    @asyncio.coroutine
     def get_item_price(self, item_type_id):
+        """ Returns the price (if it is in database), from the price cache if possible """
+        try:
+            return self.price_cache[item_type_id]
+        except KeyError:
+            price = yield from self.get_item_price_from_db(item_type_id)
+            self.price_cache[item_type_id] = price
+            return price
+
+    @asyncio.coroutine
+    def get_item_prices(self, type_ids):
+        """ Returns a dictionary type id -> price (or None) for a list of type ids. Prices
+        that are not in the price cache are fetched with a single query """
+        prices = {}
+        missing = []
+        for type_id in set(type_ids):
+            try:
+                prices[type_id] = self.price_cache[type_id]
+            except KeyError:
+                missing.append(type_id)
+
+        if len(missing) > 0:
+            db_prices = yield from self.get_item_prices_from_db(missing)
+            for type_id in missing:
+                prices[type_id] = db_prices.get(type_id)
+                self.price_cache[type_id] = prices[type_id]
+        return prices
+
+    @threaded_query
+    def get_item_prices_from_db(self, db, type_ids):
+        """ Returns a dictionary type id -> price for all type ids that have a price """
+        sql = """SELECT type_id, sell FROM prices WHERE type_id IN (""" + ", ".join(["%s"] * len(type_ids)) + ")"
+        with db.cursor() as cursor:
+            cursor.execute(sql, tuple(type_ids))
+            prices = {}
+            for row in cursor:
+                prices[row['type_id']] = row['sell']
+            cursor.close()
+            return prices
+
+    @asyncio.coroutine
+    def refresh_prices(self):
+        """ Reloads the prices table into the price cache with one query """
+        prices = yield from self.get_all_prices()
+        self.price_cache.refresh(prices)
+        return len(prices)
+
+    @threaded_query
+    def get_all_prices(self, db):
+        """ Returns a dictionary of all prices by type id """
+        sql = """SELECT type_id, sell FROM prices"""
+        with db.cursor() as cursor:
+            cursor.execute(sql)
+            prices = {}
+            for row in cursor:
+                prices[row['type_id']] = row['sell']
+            cursor.close()
+            return prices
+
+    @threaded_query
+    def get_item_price_from_db(self, db, item_type_id):
         """ REturns the price (if it is in database) """
-        sql = """SELECT sell FROM prices WHERE type_id=%s"""
-        with self.db.cursor() as cursor:
-            number = cursor.execute(sql, (item_type_id,))
+        with db.cursor() as cursor:
+            number = cursor.execute(ITEM_PRICE_SQL, (item_type_id,))
             if number == 1:
                 result = cursor.fetchone()
                 cursor.close()
@@ -229,14 +573,72 @@ class MyDBModel:
 
 
 
+    @threaded_query
+    def get_all_published_items(self, db):
+        """ Returns a list of all published items """
+        sql = """SELECT typeName, typeID, description
+            FROM eve_staticdata.invTypes
+            WHERE published=1"""
+        with db.cursor() as cursor:
+            cursor.execute(sql)
+            items = []
+            for row in cursor:
+                items.append({'id': row['typeID'], 'name': row['typeName'], 'description': row['description']})
+            cursor.close()
+            return items
+
+    @asyncio.coroutine
     def find_item(self, item_str):
+        """ Returns info about item, uses the item index if it is loaded """
+        if self.item_index is not None:
+            return self.item_index.find(item_str)
+
+        result = yield from self.find_item_in_db(item_str)
+        return result
+
+    @asyncio.coroutine
+    def find_items_by_name(self, names):
+        """ Returns a dictionary lower case name -> item (id, name, description) for all
+        names that are exactly the name of an item """
+        if self.item_index is not None:
+            return self.item_index.get_many(names)
+
+        result = yield from self.find_items_by_name_in_db(names)
+        return result
+
+    @threaded_query
+    def find_items_by_name_in_db(self, db, names):
+        """ Returns a dictionary lower case name -> item for all names that are exactly the name of an item """
+        if len(names) == 0:
+            return {}
+        sql = """SELECT typeName, typeID, description
+            FROM eve_staticdata.invTypes
+            WHERE published=1 AND typeName IN (""" + ", ".join(["%s"] * len(names)) + ")"
+        with db.cursor() as cursor:
+            cursor.execute(sql, tuple(names))
+            items = {}
+            for row in cursor:
+                items[row['typeName'].lower()] = {'id': row['typeID'], 'name': row['typeName'], 'description': row['description']}
+            cursor.close()
+            return items
+
+    @asyncio.coroutine
+    def suggest_item(self, item_str):
+        """ Returns a list of item names close to item_str (typos), empty if the item
+        index is not loaded """
+        if self.item_index is None:
+            return []
+        return self.item_index.suggest(item_str)
+
+    @threaded_query
+    def find_item_in_db(self, db, item_str):
         """ Returns info about item """
         orig_item_str = item_str
         item_str = "%" + item_str + "%"
         sql = """SELECT typeName, typeID, description
             FROM eve_staticdata.invTypes
             WHERE published=1 AND typeName LIKE %s ORDER BY typename ASC LIMIT 0,5"""
-        with self.db.cursor() as cursor:
+        with db.cursor() as cursor:
             number = cursor.execute(sql, (item_str,))
             if number == 1:
                 result = cursor.fetchone()
@@ -257,72 +659,162 @@ class MyDBModel:
                 return item_list
 
 
-    def get_expensive_killmails(self, last_id=0):
-        """ returns the most expensive kill within the last 3 hours """
-        sql = """SELECT external_kill_ID
-            FROM  `kills_killmails`
-            WHERE zkb_total_value > 2000000000 AND external_kill_ID > %s
-            AND TIMESTAMPDIFF(HOUR,kill_time, now()) < 3
-            ORDER BY kill_time DESC
-            LIMIT 0 , 1"""
-        with self.db.cursor() as cursor:
-            cursor.execute(sql, (str(last_id),))
-            try:
-                result = cursor.fetchone()
-                return result['external_kill_ID']
-            except:
+    @threaded_query
+    def get_expensive_killmails(self, db, last_id=0, min_value=2000000000, limit=50,
+                                with_regions=False, with_ship_groups=False):
+        """ returns up to limit kills from the last 3 hours that are worth more than
+        min_value and have an id > last_id, ordered by id. Every kill is a dictionary
+        with id, value, region_id and ship_group_id (None unless with_regions and
+        with_ship_groups are set) """
+        with db.cursor() as cursor:
+            cursor.execute(get_expensive_killmails_sql(with_regions, with_ship_groups), (min_value, int(last_id), limit))
+            kills = []
+            for row in cursor:
+                kills.append({
+                    'id': row['external_kill_ID'],
+                    'value': row['zkb_total_value'],
+                    'region_id': row.get('regionID'),
+                    'ship_group_id': row.get('groupID')
+                })
+            cursor.close()
+            return kills
+        return []
+
+    @threaded_query
+    def get_killmail_max_id(self, db):
+        """ returns the highest external kill id in kills_killmails """
+        with db.cursor() as cursor:
+            sql = """SELECT max(external_kill_ID) as max_id FROM kills_killmails """
+            cursor.execute(sql)
+
+            row = cursor.fetchone()
+            max_id = row['max_id']
+
+            if max_id is None: # no kills yet
                 return 0
+            return max_id
         return 0
 
 
-    def get_fleetbot_messages(self, last_id=0):
-        """ returns a list of fleetbot messages by group """
-        with self.db.cursor() as cursor:
-            sql = """SELECT id, from_character, `timestamp`, message, groupname
-            FROM irc_ping_history WHERE id > %s ORDER BY `timestamp` ASC """
-            cursor.execute(sql, (str(last_id),))
-
-            messages_by_group = {}
+    @threaded_query
+    def get_fleetbot_messages(self, db, last_id=0, limit=100):
+        """ returns a list of up to limit fleetbot messages with id > last_id, ordered by id """
+        with db.cursor() as cursor:
+            cursor.execute(FLEETBOT_MESSAGES_SQL, (int(last_id), limit))
 
-            msg_cnt = 0
+            messages = []
 
             for row in cursor:
-                group = row['groupname']
-                if group not in messages_by_group:
-                    messages_by_group[group] = []
-
-                messages_by_group[group].append(
+                messages.append(
                     {
                         'id': row['id'],
+                        'group': row['groupname'],
                         'from': row['from_character'],
                         'timestamp': row['timestamp'],
-                        'message': row['message'],
-                        'forward': True
+                        'message': row['message']
                     }
                 )
-                msg_cnt += 1
             # end for
             cursor.close()
 
-            if msg_cnt > 0:
-                logging.info("Fleetbot: There are %d message to be sent!", msg_cnt)
-
-            duplicates = 0
-            # filter duplicates because fuck spam pings
-            for group in messages_by_group.keys():
-                msgs = messages_by_group[group]
-
-                last_msg = ""
+            if len(messages) > 0:
+                logging.info("Fleetbot: There are %d message to be sent!", len(messages))
 
-                for i in range(0, len(msgs)):
-                    if msgs[i]['message'] == last_msg:
-                        msgs[i]['forward'] = False
-                        duplicates += 1
-
-                    last_msg = msgs[i]['message']
-
-            if duplicates > 0:
-                logging.info("Fleetbot: Found %d duplicates!", duplicates)
+            return messages
+        return []
 
-            return messages_by_group
-        return {}
+    @threaded_query
+    def get_auth_prompts(self, db, max_age):
+        """ returns a dictionary which maps the member ids that were asked to auth within
+        the last max_age seconds to the time they were asked (unix time) """
+        with db.cursor() as cursor:
+            sql = """SELECT member_id, UNIX_TIMESTAMP(asked_at) AS asked_at FROM discordbot_auth_prompts
+            WHERE asked_at > NOW() - INTERVAL %s SECOND"""
+            cursor.execute(sql, (int(max_age),))
+            prompts = {}
+            for row in cursor:
+                prompts[row['member_id']] = float(row['asked_at'])
+            cursor.close()
+            return prompts
+
+    @threaded_query
+    def set_auth_prompt(self, db, member_id):
+        """ stores that member_id was asked to auth just now """
+        with db.cursor() as cursor:
+            sql = """INSERT INTO discordbot_auth_prompts (member_id, asked_at) VALUES (%s, NOW())
+            ON DUPLICATE KEY UPDATE asked_at = VALUES(asked_at)"""
+            cursor.execute(sql, (str(member_id),))
+            cursor.close()
+            db.commit()
+
+    @threaded_query
+    def get_bot_state(self, db, name):
+        """ returns the persisted value of name (as string), or None """
+        with db.cursor() as cursor:
+            sql = """SELECT value FROM discordbot_state WHERE name = %s"""
+            number = cursor.execute(sql, (name,))
+            if number == 0:
+                cursor.close()
+                return None
+            row = cursor.fetchone()
+            cursor.close()
+            return row['value']
+
+    @threaded_query
+    def set_bot_state(self, db, name, value):
+        """ persists value (as string) under name """
+        with db.cursor() as cursor:
+            sql = """INSERT INTO discordbot_state (name, value) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE value = VALUES(value)"""
+            cursor.execute(sql, (name, str(value)))
+            cursor.close()
+            db.commit()
+
+    @threaded_query
+    def enqueue_fleetbot_outbox(self, db, entries, last_message_id):
+        """ inserts entries (list of (channel_id, message)) into discordbot_outbox and
+        sets the fleetbot watermark to last_message_id in one transaction. Returns
+        the list of new outbox ids """
+        db.begin()
+        with db.cursor() as cursor:
+            entry_ids = []
+            sql = """INSERT INTO discordbot_outbox (channel_id, message) VALUES (%s, %s)"""
+            for channel_id, message in entries:
+                cursor.execute(sql, (channel_id, message))
+                entry_ids.append(cursor.lastrowid)
+
+            sql = """INSERT INTO discordbot_state (name, value) VALUES ('fleetbot_last_message_id', %s)
+            ON DUPLICATE KEY UPDATE value = VALUES(value)"""
+            cursor.execute(sql, (str(last_message_id),))
+            cursor.close()
+            db.commit()
+            return entry_ids
+
+    @threaded_query
+    def get_fleetbot_outbox(self, db):
+        """ returns all pending (not dead-lettered) outbox entries, ordered by id """
+        with db.cursor() as cursor:
+            sql = """SELECT id, channel_id, message, attempts FROM discordbot_outbox
+            WHERE dead = 0 ORDER BY id ASC"""
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+
+    @threaded_query
+    def ack_fleetbot_outbox(self, db, entry_ids):
+        """ deletes delivered outbox entries """
+        with db.cursor() as cursor:
+            sql = """DELETE FROM discordbot_outbox WHERE id IN (""" + ", ".join(["%s"] * len(entry_ids)) + ")"
+            cursor.execute(sql, tuple(entry_ids))
+            cursor.close()
+            db.commit()
+
+    @threaded_query
+    def update_fleetbot_outbox_attempts(self, db, entry_id, attempts, dead):
+        """ stores the number of failed attempts of an outbox entry, and whether it was dead-lettered """
+        with db.cursor() as cursor:
+            sql = """UPDATE discordbot_outbox SET attempts = %s, dead = %s WHERE id = %s"""
+            cursor.execute(sql, (attempts, 1 if dead else 0, entry_id))
+            cursor.close()
+            db.commit()
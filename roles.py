@@ -0,0 +1,356 @@
+""" Reconciliation of discord roles: compares the roles that members should have
+with the roles they have, and changes every member that differs with a single
+replace_roles call """
+
+import asyncio
+import collections
+import logging
+import sys
+import time
+
+
+def is_in_ping_window(start_hour, stop_hour, hour):
+    """ True if time dependent roles are assigned at hour (UTC) for a member with
+    ping_start_hour and ping_stop_hour """
+    # case 0: user does not care about any time dependency
+    if start_hour == 0 and stop_hour == 0:
+        return True
+    # case 1: start_hour < stop_hour, e.g., between 8 and 22 hours
+    if start_hour < stop_hour:
+        return start_hour <= hour < stop_hour
+    # case 2: start_hour > stop_hour, e.g., between 16 and 4 hours
+    if start_hour > stop_hour:
+        return hour >= start_hour or hour < stop_hour
+    return False
+
+
+class RoleChange:
+    """ The planned change of one member: roles is the complete new list of roles
+    (without @everyone), added and removed are sets of role IDs. applied_at is the
+    time (monotonic) at which replace_roles returned, None until then """
+
+    def __init__(self, member, roles, added, removed):
+        self.member = member
+        self.roles = roles
+        self.added = added
+        self.removed = removed
+        self.applied_at = None
+
+    def __repr__(self):
+        return "RoleChange({}, added={}, removed={})".format(self.member.name, sorted(self.added), sorted(self.removed))
+
+
+def get_role_ids(member, everyone_role):
+    """ returns the set of role IDs of member, without @everyone """
+    return set([str(role.id) for role in member.roles if role != everyone_role])
+
+
+def plan_role_change(member, desired_role_ids, roles, everyone_role):
+    """ compares the roles of member with desired_role_ids. roles maps role IDs to
+    the roles of the server. Returns the RoleChange (or None if the member already
+    has the desired roles) and the set of desired role IDs that do not exist """
+    unknown = set([role_id for role_id in desired_role_ids if role_id not in roles])
+    desired = set(desired_role_ids) - unknown
+    actual = get_role_ids(member, everyone_role)
+
+    if desired == actual:
+        return None, unknown
+
+    new_roles = [roles[role_id] for role_id in sorted(desired)]
+    return RoleChange(member, new_roles, desired - actual, actual - desired), unknown
+
+
+class RoleReconciler:
+    """ Plans and applies role changes. Members whose roles already match cost no
+    API call (and no delay), so a pass scales with the number of changed members.
+
+    A circuit breaker holds back plans that would remove roles from more than
+    max_removals members or more than max_removal_percent of the members of the
+    server (e.g., after the database returned no authed members). Small batches
+    (e.g., from the reconcile queue) are checked together: the members that lost
+    roles within the last removal_window seconds count as well. The plan is
+    reported and held until it is applied with apply_held() """
+
+    def __init__(self, replace_roles, report, max_removals=25, max_removal_percent=10, delay=0.5,
+                 removal_window=3600):
+        self.replace_roles = replace_roles # coroutine replace_roles(member, *roles)
+        self.report = report # coroutine report(message), e.g. to the debug channel
+        self.max_removals = max_removals
+        self.max_removal_percent = max_removal_percent
+        self.delay = delay # pause after every API call
+        self.removal_window = removal_window
+
+        self.held = [] # changes held back by the circuit breaker
+        # member id -> time (monotonic) of the last planned removal, applied or held
+        self.recent_removals = collections.OrderedDict()
+
+        self.checked = 0
+        self.changed = 0
+        self.failed = 0
+        self.trips = 0
+        self.last_pass_duration = 0.0
+
+    def plan(self, member, desired_role_ids, roles, everyone_role):
+        """ see plan_role_change, also counts the checked members """
+        self.checked += 1
+        change, unknown = plan_role_change(member, desired_role_ids, roles, everyone_role)
+        if len(unknown) > 0:
+            logging.error("Member %s should have roles %s, but I could not find them", member.name, sorted(unknown))
+        return change, unknown
+
+    def is_mass_removal(self, removals, total):
+        """ True if removing roles from removals of total members trips the circuit
+        breaker: more than max_removals members or more than max_removal_percent """
+        if removals > self.max_removals:
+            return True
+        return removals > 0 and (total == 0 or 100.0 * removals / total > self.max_removal_percent)
+
+    def get_recent_removals(self, now):
+        """ returns the number of members that lost roles within the removal window """
+        while len(self.recent_removals) > 0:
+            member_id, removed_at = next(iter(self.recent_removals.items()))
+            if now - removed_at <= self.removal_window:
+                break
+            del self.recent_removals[member_id]
+        return len(self.recent_removals)
+
+    def hold(self, removals):
+        """ holds removals back, replacing older held changes of the same members """
+        member_ids = set([str(change.member.id) for change in removals])
+        self.held = [change for change in self.held if str(change.member.id) not in member_ids] + removals
+
+    @asyncio.coroutine
+    def apply(self, changes, total, population=0, pass_removals=None):
+        """ applies a list of RoleChange (planned for total members of population
+        members on the server), one replace_roles call per member. Changes that
+        remove roles are held back if there are too many, in this batch or together
+        with the removals of the removal window. If changes are part of a longer
+        pass, total and pass_removals are the numbers of the whole pass so far """
+        now = time.monotonic()
+        removals = [change for change in changes if len(change.removed) > 0]
+        if pass_removals is None:
+            pass_removals = len(removals)
+        recent = self.get_recent_removals(now)
+        new_member_ids = set([str(change.member.id) for change in removals]) - set(self.recent_removals.keys())
+        window_removals = recent + len(new_member_ids)
+
+        # percentages of the whole server, a batch of a few members is no sample
+        total = max(total, population)
+        if len(removals) > 0 and (self.is_mass_removal(pass_removals, total)
+                                  or self.is_mass_removal(window_removals, total)):
+            self.trips += 1
+            was_holding = len(self.held) > 0
+            self.hold(removals)
+            changes = [change for change in changes if len(change.removed) == 0]
+            logging.error("Role sync: %d of %d members would lose roles (%d within %d s), holding these changes back",
+                          pass_removals, total, window_removals, self.removal_window)
+            # the first trip is reported, later ones only add to the held changes
+            if not was_holding:
+                yield from self.report(self.get_plan_summary(removals, pass_removals, total, window_removals))
+
+        # held removals count as well, so the breaker stays open until apply_held()
+        for change in removals:
+            member_id = str(change.member.id)
+            self.recent_removals.pop(member_id, None)
+            self.recent_removals[member_id] = now
+
+        yield from self.apply_changes(changes)
+
+    @asyncio.coroutine
+    def apply_changes(self, changes):
+        start = time.monotonic()
+        for change in changes:
+            logging.info("Member %s: adding roles %s, removing roles %s", change.member.name,
+                         sorted(change.added), sorted(change.removed))
+            try:
+                yield from self.replace_roles(change.member, *change.roles)
+                change.applied_at = time.monotonic()
+                self.changed += 1
+                yield from asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.info("Failed to change the roles of %s... Probably rate limited? %s",
+                             change.member.name, str(sys.exc_info()[0]))
+                self.failed += 1
+                yield from asyncio.sleep(3)
+        self.last_pass_duration = time.monotonic() - start
+
+    @asyncio.coroutine
+    def apply_held(self, roles, everyone_role):
+        """ applies the changes held back by the circuit breaker, planned again against
+        the current roles of the members. Returns the number of changes """
+        held = self.held
+        self.held = []
+        self.recent_removals.clear()
+
+        changes = []
+        for change in held:
+            desired_role_ids = [str(role.id) for role in change.roles]
+            new_change, unknown = plan_role_change(change.member, desired_role_ids, roles, everyone_role)
+            if new_change is not None:
+                changes.append(new_change)
+
+        yield from self.apply_changes(changes)
+        return len(changes)
+
+    def get_plan_summary(self, removals, pass_removals, total, window_removals, limit=20):
+        summary = "Role sync paused: {} of {} members would lose roles ({} members within the last {} s). Check the database, then use !apply_roles to apply it anyway.".format(
+            pass_removals, total, window_removals, self.removal_window)
+        for change in removals[:limit]:
+            summary += "\n{}: -{}".format(change.member.name, ", -".join(sorted(change.removed)))
+        if len(removals) > limit:
+            summary += "\n... and {} more".format(len(removals) - limit)
+        return summary
+
+    def get_stats_str(self):
+        return "{} members checked, {} changed, {} failed, {} held back ({} trips), {} recent removals, last apply took {:.1f} s".format(
+            self.checked, self.changed, self.failed, len(self.held), self.trips,
+            self.get_recent_removals(time.monotonic()), self.last_pass_duration)
+
+
+class ReconcileQueue:
+    """ The IDs of members that need to be reconciled, in the order in which they
+    were added. A member that is already waiting is only reconciled once """
+
+    def __init__(self):
+        self.member_ids = collections.OrderedDict()
+        self.added = asyncio.Event()
+
+        self.enqueued = 0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.member_ids)
+
+    def add(self, member_id):
+        self.member_ids[str(member_id)] = True
+        self.enqueued += 1
+        self.added.set()
+
+    @asyncio.coroutine
+    def get(self, timeout):
+        """ waits up to timeout seconds for members and returns (and removes) the
+        list of all waiting member IDs """
+        try:
+            yield from asyncio.wait_for(self.added.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.added.clear()
+
+        member_ids = list(self.member_ids.keys())
+        self.member_ids.clear()
+        if len(member_ids) > 0:
+            self.batches += 1
+        return member_ids
+
+    def get_stats_str(self):
+        return "{} waiting, {} enqueued, {} batches".format(len(self.member_ids), self.enqueued, self.batches)
+
+
+class PingWindowWheel:
+    """ 24 buckets (one per UTC hour) with the IDs of the members whose ping window
+    opens or closes at that hour. Only those members need to be reconciled when
+    the hour changes """
+
+    def __init__(self):
+        self.buckets = [set() for hour in range(0, 24)]
+        self.windows = {} # member id -> (start hour, stop hour)
+
+    def update(self, member_id, start_hour, stop_hour):
+        """ sets the ping window of member_id """
+        self.remove(member_id)
+        start_hour, stop_hour = int(start_hour), int(stop_hour)
+        # no window (always assigned) or an empty window: nothing changes at any hour
+        if start_hour == stop_hour:
+            return
+        self.windows[member_id] = (start_hour, stop_hour)
+        self.buckets[start_hour % 24].add(member_id)
+        self.buckets[stop_hour % 24].add(member_id)
+
+    def remove(self, member_id):
+        if member_id in self.windows:
+            start_hour, stop_hour = self.windows.pop(member_id)
+            self.buckets[start_hour % 24].discard(member_id)
+            self.buckets[stop_hour % 24].discard(member_id)
+
+    def rebuild(self, authed_users):
+        """ rebuilds all buckets from authed_users (member id -> dict with start_hour and stop_hour) """
+        self.buckets = [set() for hour in range(0, 24)]
+        self.windows = {}
+        for member_id, user in authed_users.items():
+            self.update(member_id, user['start_hour'], user['stop_hour'])
+
+    def get_members(self, hour):
+        """ returns the IDs of the members whose window opens or closes at hour """
+        return list(self.buckets[hour % 24])
+
+    def get_stats_str(self):
+        return "{} members with a ping window, largest hour bucket {}".format(
+            len(self.windows), max([len(bucket) for bucket in self.buckets]))
+
+
+def get_sweep_delay(lanes, now):
+    """ returns the number of seconds until one of lanes is due (at least one second) """
+    delay = None
+    for lane in lanes:
+        if len(lane) > 0:
+            lane_delay = 0
+        else:
+            lane_delay = lane.next_pass - now
+        if delay is None or lane_delay < delay:
+            delay = lane_delay
+    return max(delay, 1)
+
+
+class SweepLane:
+    """ The member IDs that one lane of the full sweep still has to check. A pass
+    may be spread over several runs (see the time budget in verify_users), it
+    ends when the lane is empty. The next pass starts interval seconds after
+    the start of the last one """
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.member_ids = collections.deque()
+        self.group_roles = {} # roles from the database, loaded at the start of the pass
+
+        self.next_pass = 0
+        self.pass_start = None
+        self.last_pass_duration = 0.0
+        self.passes = 0
+
+        # counted over the whole pass, for the circuit breaker of the role reconciler
+        self.checked = 0
+        self.removals = 0
+
+    def __len__(self):
+        return len(self.member_ids)
+
+    def is_due(self, now):
+        return len(self.member_ids) > 0 or now >= self.next_pass
+
+    def start_pass(self, member_ids, group_roles, now):
+        self.member_ids = collections.deque(member_ids)
+        self.group_roles = group_roles
+        self.pass_start = now
+        self.checked = 0
+        self.removals = 0
+
+    def pop(self):
+        return self.member_ids.popleft()
+
+    def finish_pass(self, now):
+        self.member_ids.clear()
+        self.group_roles = {}
+        if self.pass_start is not None:
+            self.last_pass_duration = now - self.pass_start
+            self.next_pass = self.pass_start + self.interval
+        else:
+            self.next_pass = now + self.interval
+        self.pass_start = None
+        self.passes += 1
+
+    def get_stats_str(self):
+        return "{} lane: {} waiting, {} checked and {} removals in this pass, {} passes, last pass took {:.1f} s".format(
+            self.name, len(self.member_ids), self.checked, self.removals, self.passes, self.last_pass_duration)
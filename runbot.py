@@ -32,6 +32,8 @@ import pymysql.connections
 import discord
 
 from  discordbot import MyDiscordBotClient
+from model import ConnectionPool
+import migrations
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
 
@@ -63,7 +65,7 @@ class MyBotApp:
         config = self.processConfigFiles(args)
 
 
-        self.db = None # type: pymysql.connections.Connection
+        self.db = None # type: model.ConnectionPool
         if self.connectToDB(args, config) == None:
             logging.info('Stopping...')
             return # could not connect to DB, exiting...
@@ -77,6 +79,7 @@ class MyBotApp:
         """ destruct the app - disconnect from DB """
         logging.info("Stopping bot app")
         if self.db != None:
+            self.db.close()
             self.db = None
 
 
@@ -99,7 +102,33 @@ class MyBotApp:
                                             config.get('Bot', 'time_dependent_groups'),
                                             config.get('Bot', 'fleetbot_channels'),
                                             config.get('Bot', 'post_expensive_killmails_to'),
-                                            run_verify_user_loop=True  # ToDo: set this to true
+                                            run_verify_user_loop=True,  # ToDo: set this to true
+                                            auth_maintenance_interval=config.getint('Bot', 'auth_maintenance_interval'),
+                                            price_cache_size=config.getint('Bot', 'price_cache_size'),
+                                            price_cache_ttl=config.getint('Bot', 'price_cache_ttl'),
+                                            price_refresh_interval=config.getint('Bot', 'price_refresh_interval'),
+                                            fleetbot_batch_size=config.getint('Bot', 'fleetbot_batch_size'),
+                                            fleetbot_max_attempts=config.getint('Bot', 'fleetbot_max_attempts'),
+                                            fleetbot_retry_delay=config.getint('Bot', 'fleetbot_retry_delay'),
+                                            fleetbot_coalesce=config.getboolean('Bot', 'fleetbot_coalesce'),
+                                            fleetbot_dedupe_window=config.getint('Bot', 'fleetbot_dedupe_window'),
+                                            fleetbot_dedupe_shared=config.getboolean('Bot', 'fleetbot_dedupe_shared'),
+                                            fleetbot_min_poll_interval=config.getfloat('Bot', 'fleetbot_min_poll_interval'),
+                                            fleetbot_max_poll_interval=config.getfloat('Bot', 'fleetbot_max_poll_interval'),
+                                            fleetbot_notify_socket=config.get('Bot', 'fleetbot_notify_socket'),
+                                            killmail_rules=config.get('Bot', 'killmail_rules'),
+                                            killmail_batch_size=config.getint('Bot', 'killmail_batch_size'),
+                                            role_sync_event_driven=config.getboolean('Bot', 'role_sync_event_driven'),
+                                            role_sync_full_interval=config.getint('Bot', 'role_sync_full_interval'),
+                                            role_sync_db_interval=config.getint('Bot', 'role_sync_db_interval'),
+                                            role_removal_limit=config.getint('Bot', 'role_removal_limit'),
+                                            role_removal_limit_percent=config.getint('Bot', 'role_removal_limit_percent'),
+                                            role_removal_window=config.getint('Bot', 'role_removal_window'),
+                                            role_sync_offline_interval=config.getint('Bot', 'role_sync_offline_interval'),
+                                            role_sync_pass_budget=config.getint('Bot', 'role_sync_pass_budget'),
+                                            debug_digest_interval=config.getfloat('Bot', 'debug_digest_interval'),
+                                            auth_prompt_reask_interval=config.getint('Bot', 'auth_prompt_reask_interval'),
+                                            auth_prompt_rate=config.getfloat('Bot', 'auth_prompt_rate')
                                             )
                 logging.info("Calling client.run()")
                 # use run_until_complete manually, as described in client.run()
@@ -140,24 +169,38 @@ class MyBotApp:
 
     def connectToDB(self, args, config):
         """ connect to the database as specified in the config file
-        :return the database object
-        :rtype pymysql.connections.Connection
+        :return the database connection pool
+        :rtype model.ConnectionPool
         """
         if self.db == None:
             # try connection to the database
             logging.debug("Connecting to database")
+            def connect():
+                return pymysql.connect(host=config.get('Database', 'dbhost'),
+                                       user=config.get('Database', 'dbuser'),
+                                       password=config.get('Database', 'dbpass'),
+                                       db=config.get('Database', 'dbname'),
+                                       charset='utf8mb4',
+                                       autocommit=True,
+                                       cursorclass=pymysql.cursors.DictCursor)
             try:
-                self.db = pymysql.connect(host=config.get('Database', 'dbhost'),
-                                             user=config.get('Database', 'dbuser'),
-                                             password=config.get('Database', 'dbpass'),
-                                             db=config.get('Database', 'dbname'),
-                                             charset='utf8mb4',
-                                             cursorclass=pymysql.cursors.DictCursor)
+                self.db = ConnectionPool(connect, config.getint('Database', 'pool_size'))
+                # make sure that the database is reachable before starting the bot
+                with self.db.connection():
+                    pass
                 logging.info("Successfully connected to database")
-                return self.db
             except:
                 logging.error("Failed to connect to database", exc_info=True)
                 return None
+
+            # create / verify tables and indexes (see migrations.py)
+            try:
+                with self.db.connection() as db:
+                    migrations.run(db, apply=config.getboolean('Database', 'migrate'),
+                                   explain=config.getboolean('Database', 'explain_check'))
+            except:
+                logging.error("Failed to migrate the database", exc_info=True)
+            return self.db
         else: # oh we already have it, fine
             return self.db
 
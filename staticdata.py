@@ -0,0 +1,208 @@
+""" In-memory indexes over the EVE static data (eve_staticdata), which never changes while the bot runs """
+
+import bisect
+import logging
+
+
+def edit_distance(a, b):
+    """ returns the edit distance between a and b, counting insertions, deletions,
+    substitutions and transpositions of two adjacent characters (optimal string alignment) """
+    before_previous = None
+    previous = list(range(0, len(b) + 1))
+    for i in range(0, len(a)):
+        current = [i + 1]
+        for j in range(0, len(b)):
+            distance = min(previous[j + 1] + 1,  # deletion
+                           current[j] + 1,  # insertion
+                           previous[j] + (a[i] != b[j]))  # substitution
+            if i > 0 and j > 0 and a[i] == b[j - 1] and a[i - 1] == b[j]:
+                distance = min(distance, before_previous[j - 1] + 1)  # transposition
+            current.append(distance)
+        before_previous, previous = previous, current
+    return previous[-1]
+
+
+class DeletionIndex:
+    """ Typo tolerant lookup of words (SymSpell style): every word is stored under all
+    strings that can be made from its prefix by deleting up to max_distance characters.
+    A lookup generates the deletions of the search word, so words within max_distance
+    are found with a few dictionary lookups and checked with edit_distance """
+
+    def __init__(self, words, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+
+        # deletion -> list of words
+        self.deletions = {}
+        for word in set(words):
+            for deletion in self.get_deletions(word):
+                if deletion not in self.deletions:
+                    self.deletions[deletion] = [word]
+                else:
+                    self.deletions[deletion].append(word)
+
+    def get_deletions(self, word):
+        """ returns the set of strings made from the prefix of word by deleting up to max_distance characters """
+        deletions = set([word[:self.prefix_length]])
+        current = deletions
+        for distance in range(0, self.max_distance):
+            current = set(deleted[:i] + deleted[i + 1:] for deleted in current for i in range(0, len(deleted)))
+            deletions.update(current)
+        return deletions
+
+    def suggest(self, word, limit=5):
+        """ returns up to limit words within max_distance of word as a list of
+        (distance, word), closest first """
+        candidates = set()
+        for deletion in self.get_deletions(word):
+            if deletion in self.deletions:
+                candidates.update(self.deletions[deletion])
+
+        suggestions = []
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > self.max_distance:
+                continue
+            distance = edit_distance(word, candidate)
+            if distance <= self.max_distance:
+                suggestions.append((distance, candidate))
+        suggestions.sort()
+        return suggestions[:limit]
+
+
+class SolarSystemIndex:
+    """ Prefix index over all solar systems: a sorted array of lower case system
+    names, searched with bisect """
+
+    def __init__(self, systems):
+        """ systems is a list of dictionaries with regionName, solarSystemID and solarSystemName """
+        self.systems = sorted(systems, key=lambda system: system['solarSystemName'].lower())
+        self.names = [system['solarSystemName'].lower() for system in self.systems]
+        self.typos = DeletionIndex(self.names)
+        logging.info("Built solar system index with %d systems", len(self.systems))
+
+    def __len__(self):
+        return len(self.systems)
+
+    def find(self, system_str):
+        """ Returns a system and region name based on system_str (partial), in the same
+        format as MyDBModel.find_system: a dict for exactly one match, None for no match
+        or a list of "system (region)" strings """
+        prefix = system_str.lower()
+        first = bisect.bisect_left(self.names, prefix)
+        last = bisect.bisect_right(self.names, prefix + chr(0x10FFFF), first)
+
+        if last - first == 1:
+            system = self.systems[first]
+            return {'regionName': system['regionName'], 'solarSystemID': system['solarSystemID'],
+                    'solarSystemName': system['solarSystemName']}
+        elif last == first:
+            return None
+        else:
+            return [system['solarSystemName'] + " (" + system['regionName'] + ")"
+                    for system in self.systems[first:last]]
+
+    def suggest(self, system_str, limit=5):
+        """ returns a list of up to limit "system (region)" strings that are close to
+        system_str (for typos), closest first """
+        suggestions = []
+        for distance, name in self.typos.suggest(system_str.lower(), limit):
+            system = self.systems[bisect.bisect_left(self.names, name)]
+            suggestions.append(system['solarSystemName'] + " (" + system['regionName'] + ")")
+        return suggestions
+
+
+class ItemIndex:
+    """ Substring index over the names of all published items. Every lower case
+    name is split into trigrams, a search intersects the posting lists of the
+    trigrams of the search string and checks the remaining candidates """
+
+    def __init__(self, items):
+        """ items is a list of dictionaries with id, name and description """
+        self.items = sorted(items, key=lambda item: item['name'].lower())
+        self.names = [item['name'].lower() for item in self.items]
+        self.by_name = dict(zip(self.names, self.items))
+
+        # trigram -> sorted list of positions in self.items
+        self.trigrams = {}
+        for pos in range(0, len(self.names)):
+            for trigram in ItemIndex.get_trigrams(self.names[pos]):
+                if trigram not in self.trigrams:
+                    self.trigrams[trigram] = [pos]
+                else:
+                    self.trigrams[trigram].append(pos)
+
+        # typo tolerant index over the words of all names
+        self.typos = DeletionIndex([word for name in self.names for word in name.split()])
+        logging.info("Built item index with %d items and %d trigrams", len(self.items), len(self.trigrams))
+
+    def __len__(self):
+        return len(self.items)
+
+    @staticmethod
+    def get_trigrams(name):
+        """ returns the set of trigrams of name """
+        return set(name[i:i + 3] for i in range(0, len(name) - 2))
+
+    def search(self, item_str, limit=5):
+        """ returns up to limit items whose name contains item_str, ordered by name """
+        needle = item_str.lower()
+
+        if len(needle) < 3:
+            # too short for trigrams, check all names
+            candidates = range(0, len(self.names))
+        else:
+            postings = sorted([self.trigrams.get(trigram, []) for trigram in ItemIndex.get_trigrams(needle)], key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates.intersection_update(posting)
+            candidates = sorted(candidates)
+
+        result = []
+        for pos in candidates:
+            if needle in self.names[pos]:
+                result.append(self.items[pos])
+                if len(result) == limit:
+                    break
+        return result
+
+    def get_many(self, names):
+        """ returns a dictionary lower case name -> item for all names that are item names (case insensitive) """
+        items = {}
+        for name in names:
+            item = self.by_name.get(name.lower())
+            if item is not None:
+                items[name.lower()] = dict(item)
+        return items
+
+    def find(self, item_str):
+        """ Returns info about item, in the same format as MyDBModel.find_item: a dict
+        for exactly one match (or an exact match among the first five), None for no
+        match or a list of up to five item names """
+        items = self.search(item_str, 5)
+
+        if len(items) == 1:
+            return dict(items[0])
+        elif len(items) == 0:
+            return None
+        else:
+            for item in items:
+                if item['name'].lower() == item_str.lower():
+                    return dict(item)
+            return [item['name'] for item in items]
+
+    def suggest(self, item_str, limit=5):
+        """ returns a list of up to limit item names that are close to item_str (for
+        typos): every word is replaced by the closest word of any item name, and the
+        corrected string is searched """
+        words = []
+        for word in item_str.lower().split():
+            suggestions = self.typos.suggest(word, 1)
+            if len(suggestions) == 0:
+                return []
+            words.append(suggestions[0][1])
+
+        if len(words) == 0:
+            return []
+        return [item['name'] for item in self.search(" ".join(words), limit)]